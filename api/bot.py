@@ -1,218 +1,378 @@
 import os
+import time
 import logging
-from fastapi import FastAPI, Request, HTTPException
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, InlineQueryHandler, filters
 
-# Import handlers and state from existing bot module
-import bot as bot_module
+import capture
+import logging_setup
+import metrics
+import startup_profile
+from dedupe import UpdateDeduplicator
+from warmup import WarmupManager
 
-logging.basicConfig(level=logging.WARNING)
+with startup_profile.phase("import fastapi"):
+    from fastapi import FastAPI, Request, HTTPException
+    from fastapi.responses import Response
+
+# Import handlers and state from existing bot module (python-telegram-bot
+# itself is only imported once an update needs the PTB application)
+with startup_profile.phase("import bot module"):
+    import bot as bot_module
+
+# JSON records written by a background thread, never on the event loop
+logging_setup.configure()
 logger = logging.getLogger(__name__)
-# Suppress noisy third-party loggers
-logging.getLogger("httpx").setLevel(logging.ERROR)
-logging.getLogger("telegram").setLevel(logging.WARNING)
 
 TOKEN = os.getenv("BOT_TOKEN")
 if not TOKEN:
     raise RuntimeError("BOT_TOKEN not found in environment variables")
 
+# Answer inline queries and read-only commands inside the webhook response
+# itself instead of making a separate outbound Bot API call
+FAST_PATH = os.getenv("WEBHOOK_FAST_PATH", "1") == "1"
+
+# Optional bearer token required to scrape /metrics
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+# Raw webhook bodies sampled to WEBHOOK_CAPTURE_FILE for bench/replay.py (off by default)
+webhook_capture = capture.from_env()
+
 app = FastAPI()
 
-# Create a single Application instance reused across warm invocations
-ptb_app = Application.builder().token(TOKEN).build()
-_initialized = False
+# An instance may be frozen or recycled right after responding, so every
+# webhook request stores the videos it brought instead of batching them
+bot_module.ingest_batcher.immediate = True
+
+# A single Application instance reused across warm invocations, built on
+# first use. Updates of the same chat/user stay ordered; unrelated ones run
+# concurrently through its update processor.
+ptb_app = None
+
+
+def _update_stats(field):
+    """Update processor stat for the metrics callbacks (None before PTB is built)."""
+    if ptb_app is None:
+        return None
+    return ptb_app.update_processor.stats()[field]
+
+
+metrics.CallbackMetric(
+    "bot_updates_in_flight", "Updates currently being processed", lambda: _update_stats("in_flight"))
+metrics.CallbackMetric(
+    "bot_updates_queued", "Updates waiting for a worker", lambda: _update_stats("queue_depth"))
+metrics.CallbackMetric(
+    "bot_updates_processed_total", "Updates processed by PTB",
+    lambda: _update_stats("processed"), kind="counter")
+metrics.CallbackMetric(
+    "bot_outbound_queued", "Outbound Bot API calls waiting for the scheduler",
+    lambda: ptb_app.bot.rate_limiter.stats()["waiting"] if ptb_app is not None else None)
+
+
+def _get_ptb_app():
+    """Build the PTB application (importing PTB) on first use."""
+    global ptb_app
+    if ptb_app is None:
+        with startup_profile.phase("build application"):
+            ptb_app = bot_module.build_application(TOKEN, bot_module.bot_identity)
+    return ptb_app
+
+
+async def _load_state():
+    with startup_profile.phase("load state"):
+        await bot_module.load_state()
+
+
+async def _ensure_state():
+    """Load persisted state and the cached bot identity once per instance."""
+    await warmup.once("load_state", _load_state)
+
+
+async def _initialize_ptb():
+    """Initialize PTB, reusing the cached identity (if loaded) so no getMe is needed."""
+    application = _get_ptb_app()
+    with startup_profile.phase("initialize application"):
+        await application.initialize()
+    bot_module.remember_bot_identity(application.bot.bot)
+
+
+async def _ping_telegram():
+    await _get_ptb_app().bot.get_me()
+
+
+async def _ping_state():
+    # One version read; also picks up changes made by other instances
+    await bot_module.revalidate_state(force=True)
 
-# Register the same handlers as in polling mode
-ptb_app.add_handler(CommandHandler("start", bot_module.start))
-ptb_app.add_handler(CommandHandler("clear", bot_module.clear_video))
-ptb_app.add_handler(CommandHandler("status", bot_module.status))
-ptb_app.add_handler(MessageHandler(filters.VIDEO, bot_module.store_video_handler))
-ptb_app.add_handler(InlineQueryHandler(bot_module.inline_query_handler))
-ptb_app.add_error_handler(bot_module.on_error)
+
+# Initialization runs once even when the first requests arrive together;
+# afterwards both outbound pools are pinged every WARM_KEEPALIVE_SECONDS
+warmup = WarmupManager(
+    {"telegram": _ping_telegram, "state": _ping_state},
+    interval=float(os.getenv("WARM_KEEPALIVE_SECONDS", "20")),
+)
+
+
+# Recently seen update_ids; with UPDATE_DEDUPE_TTL_SECONDS > 0 they are also
+# claimed in the state store so redeliveries to other instances are caught
+dedupe = UpdateDeduplicator(
+    window=int(os.getenv("UPDATE_DEDUPE_WINDOW", "4096")),
+    store=bot_module.state_store,
+    ttl=int(os.getenv("UPDATE_DEDUPE_TTL_SECONDS", "0")),
+)
+
+
+async def _ensure_initialized(wait_for_state: bool = True):
+    """Initialize PTB once per instance and start keeping its connections warm.
+
+    Waits for the state first (which holds the cached bot identity) unless
+    wait_for_state is False: inline queries have already waited for it as
+    long as their budget allows, and PTB falls back to getMe without it.
+    """
+    if wait_for_state:
+        await _ensure_state()
+    await warmup.once("initialize", _initialize_ptb)
+    warmup.start_keepalive()
+
+
+async def _warm_up(force: bool = False):
+    """Initialize on first use, then ping Telegram and the state store in parallel.
+
+    Pings run on the first warm-up and whenever force is set (the cron).
+    """
+    first = not warmup.is_done("initialize")
+    try:
+        await _ensure_initialized()
+    except Exception as exc:
+        logger.exception("Failed to initialize PTB app during warm-up", exc_info=exc)
+        return
+    if first or force:
+        timings = await warmup.warm()
+        logger.info("Warm-up pings: %s", timings)
+
+
+def _health_payload() -> dict:
+    payload = {
+        "ok": True,
+        "warmup": warmup.stats(),
+        "dedupe": dedupe.stats(),
+        "user_cache": bot_module.user_libraries.stats(),
+        "ingest": bot_module.ingest_batcher.stats(),
+    }
+    if ptb_app is not None:
+        payload["updates"] = ptb_app.update_processor.stats()
+        payload["outbound"] = ptb_app.bot.rate_limiter.stats()
+    if webhook_capture is not None:
+        payload["capture"] = webhook_capture.stats()
+    if startup_profile.ENABLED:
+        payload["startup"] = startup_profile.report()
+    return payload
 
 
 @app.get("/")
 async def health_root() -> dict:
     # Warm initialization on health check to reduce cold start latency
-    global _initialized
-    if not _initialized:
-        try:
-            import time as _t
-            start_ns = _t.time()
-            await ptb_app.initialize()
-            _initialized = True
-            init_ms = int((_t.time() - start_ns) * 1000)
-            logger.info(f"PTB Application initialized via GET / in {init_ms}ms")
-            try:
-                state_start_ns = _t.time()
-                bot_module.load_state()
-                state_ms = int((_t.time() - state_start_ns) * 1000)
-                logger.info(f"State loaded on GET / in {state_ms}ms")
-            except Exception as exc:
-                logger.exception("Failed to load state on GET /", exc_info=exc)
-            # Warm Telegram and Redis in parallel where possible
-            try:
-                import asyncio as _a
-                async def _warm_getme():
-                    try:
-                        bot_start_ns = _t.time()
-                        await ptb_app.bot.get_me()
-                        return int((_t.time() - bot_start_ns) * 1000)
-                    except Exception as exc_inner:
-                        logger.exception("Failed to warm bot.get_me on GET /", exc_info=exc_inner)
-                        return None
-                async def _warm_redis():
-                    if getattr(bot_module, 'redis_client', None) is None:
-                        return None
-                    kv_start_ns = _t.time()
-                    try:
-                        await _a.to_thread(bot_module.redis_client.get, 'stored_video')
-                    except Exception:
-                        pass
-                    return int((_t.time() - kv_start_ns) * 1000)
-                res_getme_ms, res_kv_ms = await _a.gather(_warm_getme(), _warm_redis())
-                if res_getme_ms is not None:
-                    logger.info(f"Bot get_me warmed in {res_getme_ms}ms on GET /")
-                if res_kv_ms is not None:
-                    logger.info(f"Redis warm GET completed in {res_kv_ms}ms on GET /")
-            except Exception as exc:
-                logger.exception("Parallel warm failed on GET /", exc_info=exc)
-        except Exception as exc:
-            logger.exception("Failed to initialize PTB app on GET /", exc_info=exc)
-            # Still return ok
+    with metrics.WARM_SECONDS.time("health_root"):
+        await _warm_up()
     return {"ok": True}
 
+
 @app.get("/api/bot")
 async def health_full(request: Request) -> dict:
-    # Warm initialization on health check to reduce cold start latency
-    global _initialized
-    if not _initialized:
-        try:
-            import time as _t
-            start_ns = _t.time()
-            await ptb_app.initialize()
-            _initialized = True
-            init_ms = int((_t.time() - start_ns) * 1000)
-            logger.info(f"PTB Application initialized via GET /api/bot in {init_ms}ms")
-            try:
-                state_start_ns = _t.time()
-                bot_module.load_state()
-                state_ms = int((_t.time() - state_start_ns) * 1000)
-                logger.info(f"State loaded on GET /api/bot in {state_ms}ms")
-            except Exception as exc:
-                logger.exception("Failed to load state on GET /api/bot", exc_info=exc)
-            # Warm Telegram and Redis in parallel where possible
-            try:
-                import asyncio as _a
-                async def _warm_getme():
-                    try:
-                        bot_start_ns = _t.time()
-                        await ptb_app.bot.get_me()
-                        return int((_t.time() - bot_start_ns) * 1000)
-                    except Exception as exc_inner:
-                        logger.exception("Failed to warm bot.get_me on GET /api/bot", exc_info=exc_inner)
-                        return None
-                async def _warm_redis():
-                    if getattr(bot_module, 'redis_client', None) is None:
-                        return None
-                    kv_start_ns = _t.time()
-                    try:
-                        await _a.to_thread(bot_module.redis_client.get, 'stored_video')
-                    except Exception:
-                        pass
-                    return int((_t.time() - kv_start_ns) * 1000)
-                res_getme_ms, res_kv_ms = await _a.gather(_warm_getme(), _warm_redis())
-                if res_getme_ms is not None:
-                    logger.info(f"Bot get_me warmed in {res_getme_ms}ms on GET /api/bot")
-                if res_kv_ms is not None:
-                    logger.info(f"Redis warm GET completed in {res_kv_ms}ms on GET /api/bot")
-            except Exception as exc:
-                logger.exception("Parallel warm failed on GET /api/bot", exc_info=exc)
-        except Exception as exc:
-            logger.exception("Failed to initialize PTB app on GET /api/bot", exc_info=exc)
-            # Still return ok
-    # Aggressive warm if explicitly requested even when already initialized
-    try:
-        warm_flag = request.query_params.get("warm")
-    except Exception:
-        warm_flag = None
-    if warm_flag == "1":
-        try:
-            import time as _t
-            import asyncio as _a
-            async def _warm_getme():
-                try:
-                    bot_start_ns = _t.time()
-                    await ptb_app.bot.get_me()
-                    return int((_t.time() - bot_start_ns) * 1000)
-                except Exception as exc_inner:
-                    logger.exception("Forced warm failed for get_me on GET /api/bot?warm=1", exc_info=exc_inner)
-                    return None
-            async def _warm_redis():
-                if getattr(bot_module, 'redis_client', None) is None:
-                    return None
-                kv_start_ns = _t.time()
-                try:
-                    await _a.to_thread(bot_module.redis_client.get, 'stored_video')
-                except Exception:
-                    pass
-                return int((_t.time() - kv_start_ns) * 1000)
-            res_getme_ms, res_kv_ms = await _a.gather(_warm_getme(), _warm_redis())
-            if res_getme_ms is not None:
-                logger.info(f"Forced warm: bot.get_me took {res_getme_ms}ms on GET /api/bot?warm=1")
-            if res_kv_ms is not None:
-                logger.info(f"Forced warm: Redis GET took {res_kv_ms}ms on GET /api/bot?warm=1")
-        except Exception as exc:
-            logger.exception("Forced parallel warm failed on GET /api/bot?warm=1", exc_info=exc)
-    return {"ok": True}
+    # ?warm=1 (the cron) pings both pools even when already initialized
+    force = request.query_params.get("warm") == "1"
+    with metrics.WARM_SECONDS.time("health_warm" if force else "health_full"):
+        await _warm_up(force)
+    return _health_payload()
+
+
+async def _start_text(user_id):
+    return bot_module.start_text()
+
+
+async def _status_text(user_id):
+    return bot_module.status_text(user_id, await bot_module.personal_library(user_id))
+
+
+# Commands whose reply only depends on cached state
+_FAST_COMMANDS = {
+    "/start": _start_text,
+    "/status": _status_text,
+}
+
+
+async def _fast_path_reply(data: dict, received: float):
+    """Build a Bot API method call to return as the webhook response, or None to use PTB.
+
+    received is the perf_counter() time the request arrived; inline answers
+    are built within INLINE_BUDGET_MS of it.
+    """
+    inline_query = data.get("inline_query")
+    if inline_query:
+        results, next_offset, _ = await bot_module.build_inline_answer(
+            inline_query.get("query", ""),
+            inline_query.get("offset", ""),
+            (inline_query.get("from") or {}).get("id", 0),
+            inline_query.get("chat_type", ""),
+            bot_module.bot_username(),
+            received,
+        )
+        bot_module.note_inline_latency(received)
+        return {
+            "method": "answerInlineQuery",
+            "inline_query_id": inline_query["id"],
+            "results": results,
+            "next_offset": next_offset,
+            "cache_time": 0,
+            "is_personal": True,
+        }
+    message = data.get("message")
+    words = ((message or {}).get("text") or "").split(maxsplit=1)
+    if not words or not words[0].startswith("/"):
+        return None
+    command, _, mention = words[0].partition("@")
+    if mention and mention.lower() != (bot_module.bot_username() or "").lower():
+        return None
+    build_text = _FAST_COMMANDS.get(command.lower())
+    if build_text is None:
+        return None
+    user_id = (message.get("from") or {}).get("id")
+    reply = {"method": "sendMessage", "chat_id": message["chat"]["id"], "text": await build_text(user_id)}
+    # Match reply_text(): quote the command outside private chats
+    if message["chat"].get("type") != "private":
+        reply["reply_to_message_id"] = message["message_id"]
+    return reply
+
+
+async def _flush_batches_if_due():
+    """Persist batched popularity counters and store idle video batches once due.
+
+    Done inline because a serverless instance may be frozen before the
+    background flush fires; between intervals this costs nothing.
+    """
+    if bot_module.popularity.flush_due:
+        await bot_module.popularity.flush()
+    if bot_module.ingest_batcher.flush_due:
+        await bot_module.ingest_batcher.flush_due_batches()
+        # Stored through the write-behind store; drain it like a PTB update
+        await bot_module.state_store.flush()
 
 
 async def _process_webhook(request: Request) -> dict:
-    global _initialized
-    if not _initialized:
-        try:
-            await ptb_app.initialize()
-            _initialized = True
-            logger.info("PTB Application initialized (lazy)")
-            # Load persisted state (Redis if configured, else JSON) on cold start
-            try:
-                bot_module.load_state()
-            except Exception as exc:
-                logger.exception("Failed to load state on startup", exc_info=exc)
-        except Exception as exc:
-            logger.exception("Failed to initialize PTB app", exc_info=exc)
-            # Still return 200 to avoid Telegram retries storm
-            return {"ok": True}
+    received = time.perf_counter()
     # Optional secret verification (recommended)
     secret = os.getenv("WEBHOOK_SECRET")
     if secret:
         header_secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token")
         if header_secret != secret:
             raise HTTPException(status_code=403, detail="Forbidden")
+    if webhook_capture is not None:
+        webhook_capture.record(request.url.path, await request.body())
     # Parse JSON body safely
     try:
         data = await request.json()
     except Exception:
         logger.warning("Webhook received non-JSON body")
         return {"ok": True}
+    if not isinstance(data, dict):
+        logger.warning("Webhook received a JSON body that is not an update")
+        return {"ok": True}
+
+    if "update_id" in data:
+        logging_setup.set_correlation_id(data["update_id"])
+
+    # Telegram redelivers updates that were not acknowledged in time; repeats
+    # are acknowledged without running handlers or replying a second time
+    if await dedupe.is_duplicate(data.get("update_id")):
+        return {"ok": True}
+
+    # Load persisted state (Redis if configured, else local files) on cold
+    # start. Inline queries only wait for their budget; the load goes on in
+    # the background and they are answered from what is in memory.
+    inline = "inline_query" in data
+    try:
+        if inline:
+            await bot_module.within_deadline(_ensure_state(), bot_module.inline_deadline(received))
+        else:
+            await _ensure_state()
+    except Exception as exc:
+        logger.exception("Failed to load state on startup", exc_info=exc)
+
+    # Fast path: reply with the method call, saving one outbound round-trip.
+    # Needs only in-memory state, so a cold start never loads PTB for it.
+    if FAST_PATH and (bot_module.bot_username() or (inline and not bot_module.state_loaded)):
+        bot_module.schedule_revalidation()
+        chosen = data.get("chosen_inline_result")
+        if chosen:
+            bot_module.record_chosen_result(
+                chosen.get("result_id"), (chosen.get("from") or {}).get("id", 0)
+            )
+            await _flush_batches_if_due()
+            return {"ok": True}
+        try:
+            reply = await _fast_path_reply(data, received)
+        except Exception as exc:
+            logger.exception("Fast-path reply failed, falling back to PTB", exc_info=exc)
+            reply = None
+        if reply is not None:
+            return reply
+
+    try:
+        await _ensure_initialized(wait_for_state=not inline)
+    except Exception as exc:
+        logger.exception("Failed to initialize PTB app", exc_info=exc)
+        # Still return 200 to avoid Telegram retries storm
+        return {"ok": True}
 
     # Process update with PTB, never bubble errors to Telegram
     try:
+        from telegram import Update
         update = Update.de_json(data, ptb_app.bot)
-        await ptb_app.process_update(update)
+        await ptb_app.update_processor.process_update(update, ptb_app.process_update(update))
     except Exception as exc:
         logger.exception("Error while processing update", exc_info=exc)
+    # Serverless instances may be frozen right after responding, so drain
+    # write-behind state here instead of relying on the background flush
+    if bot_module.state_store.dirty:
+        await bot_module.state_store.flush()
+    await _flush_batches_if_due()
     return {"ok": True}
 
 
+async def _timed_webhook(request: Request) -> dict:
+    start = time.perf_counter()
+    path = "error"
+    try:
+        reply = await _process_webhook(request)
+        # Method-call replies come from the fast path; PTB and ignored updates return ok
+        path = "fast" if "method" in reply else "ptb"
+        return reply
+    finally:
+        metrics.WEBHOOK_SECONDS.observe(time.perf_counter() - start, path)
+
+
 @app.post("/")
 async def webhook_root(request: Request) -> dict:
-    return await _process_webhook(request)
+    return await _timed_webhook(request)
 
 
 @app.post("/api/bot")
 async def webhook_full(request: Request) -> dict:
-    return await _process_webhook(request)
+    return await _timed_webhook(request)
+
+
+async def _metrics_response(request: Request) -> Response:
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+# Vercel rewrites every path to this function, so accept both spellings
+@app.get("/metrics")
+async def metrics_root(request: Request) -> Response:
+    return await _metrics_response(request)
+
+
+@app.get("/api/metrics")
+async def metrics_full(request: Request) -> Response:
+    return await _metrics_response(request)
 
 
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Cold-import benchmark for the webhook app (api.bot)
+
+Imports api.bot in fresh interpreters and fails (exit code 1) if the median
+import time exceeds the budget, or if python-telegram-bot / the Redis client
+get imported eagerly again.
+
+    python bench/cold_import.py [--runs 7] [--budget-ms 600]
+"""
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must stay lazy: they are only needed once PTB handles an update
+LAZY_MODULES = ('telegram', 'upstash_redis', 'aiohttp')
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import api.bot
+elapsed_ms = (time.perf_counter() - start) * 1000
+print(json.dumps({'ms': elapsed_ms, 'loaded': [m for m in %r if m in sys.modules]}))
+""" % (LAZY_MODULES,)
+
+
+def measure_once() -> dict:
+    env = dict(os.environ)
+    env.setdefault('BOT_TOKEN', '0:bench')
+    env['STATE_BACKEND'] = 'memory'
+    output = subprocess.run(
+        [sys.executable, '-c', _PROBE],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument(
+        '--budget-ms', type=float,
+        default=float(os.getenv('COLD_IMPORT_BUDGET_MS', '600')),
+    )
+    args = parser.parse_args()
+
+    # First run warms the bytecode cache, like a deployed function image
+    measure_once()
+    samples = [measure_once() for _ in range(args.runs)]
+    timings = sorted(sample['ms'] for sample in samples)
+    median_ms = statistics.median(timings)
+    eager = sorted({m for sample in samples for m in sample['loaded']})
+
+    print(f"api.bot cold import: median {median_ms:.1f}ms, min {timings[0]:.1f}ms, "
+          f"max {timings[-1]:.1f}ms over {args.runs} runs (budget {args.budget_ms:.0f}ms)")
+    failed = False
+    if median_ms > args.budget_ms:
+        print(f"FAIL: median cold import exceeds budget by {median_ms - args.budget_ms:.1f}ms")
+        failed = True
+    if eager:
+        print(f"FAIL: modules imported eagerly: {', '.join(eager)}")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""
+Local stand-ins for the Telegram Bot API and the Upstash Redis REST API
+
+Both are small Starlette apps served by uvicorn on 127.0.0.1 with a
+configurable injected latency, so the bot's real HTTP clients can be
+exercised without network access.
+"""
+
+import time
+import json
+import base64
+import socket
+import asyncio
+from collections import Counter
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+BOT_USER = {'id': 4242, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+
+
+class LocalServer:
+    """Run an ASGI app with uvicorn on a free local port inside the current loop."""
+
+    def __init__(self, app):
+        self.app = app
+        self.port = None
+        self._server = None
+        self._task = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    async def start(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Accepted connections inherit this; without it Nagle's algorithm plus
+        # delayed ACKs add ~40ms to every response on a reused keep-alive connection
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        config = uvicorn.Config(self.app, log_level='warning', access_log=False, lifespan='off')
+        self._server = uvicorn.Server(config)
+        self._task = asyncio.get_running_loop().create_task(self._server.serve(sockets=[sock]))
+        while not self._server.started:
+            await asyncio.sleep(0.01)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.should_exit = True
+            await self._task
+
+
+class FakeTelegram:
+    """Bot API stand-in: answers every method successfully after latency seconds.
+
+    on_call(method, params) is invoked for every request, which lets drivers
+    correlate replies (e.g. answerInlineQuery) with the updates they sent.
+    """
+
+    def __init__(self, latency: float = 0.0, on_call=None):
+        self.latency = latency
+        self.on_call = on_call
+        self.calls = Counter()
+        self.app = Starlette(routes=[
+            Route('/bot{token}/{method}', self._handle, methods=['POST', 'GET']),
+        ])
+
+    async def _params(self, request: Request) -> dict:
+        content_type = request.headers.get('content-type', '')
+        if 'json' in content_type:
+            return await request.json()
+        form = await request.form()
+        params = {}
+        for key, value in form.items():
+            try:
+                params[key] = json.loads(value)
+            except (TypeError, ValueError):
+                params[key] = value
+        return params
+
+    async def _handle(self, request: Request):
+        method = request.path_params['method']
+        params = await self._params(request)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.calls[method] += 1
+        if self.on_call is not None:
+            self.on_call(method, params)
+        if method == 'getMe':
+            result = BOT_USER
+        elif method in ('sendMessage', 'sendVideo'):
+            result = {
+                'message_id': self.calls[method],
+                'date': int(time.time()),
+                'chat': {'id': params.get('chat_id'), 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        elif method == 'getUpdates':
+            result = []
+        else:
+            result = True
+        return JSONResponse({'ok': True, 'result': result})
+
+
+class FakeUpstash:
+    """Upstash REST stand-in backed by a dict, supporting the commands the bot uses."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.data = {}
+        self.expiry = {}
+        self.commands = Counter()
+        self.app = Starlette(routes=[
+            Route('/', self._handle, methods=['POST']),
+            Route('/pipeline', self._handle_pipeline, methods=['POST']),
+        ])
+
+    def _encode(self, value, base64_encoding):
+        if isinstance(value, list):
+            return [self._encode(v, base64_encoding) for v in value]
+        if isinstance(value, str) and base64_encoding and value != 'OK':
+            return base64.b64encode(value.encode()).decode()
+        return value
+
+    def _live(self, key):
+        deadline = self.expiry.get(key)
+        if deadline is not None and deadline <= time.time():
+            self.data.pop(key, None)
+            self.expiry.pop(key, None)
+        return self.data.get(key)
+
+    def execute(self, command):
+        name = str(command[0]).upper()
+        args = [str(a) for a in command[1:]]
+        self.commands[name] += 1
+        if name == 'GET':
+            value = self._live(args[0])
+            return value if isinstance(value, str) else None
+        if name == 'SET':
+            key, value, options = args[0], args[1], [a.upper() for a in args[2:]]
+            if 'NX' in options and self._live(key) is not None:
+                return None
+            self.data[key] = value
+            self.expiry.pop(key, None)
+            if 'EX' in options:
+                self.expiry[key] = time.time() + int(options[options.index('EX') + 1])
+            return 'OK'
+        if name == 'MSET':
+            for key, value in zip(args[::2], args[1::2]):
+                self.data[key] = value
+            return 'OK'
+        if name == 'MGET':
+            return [self._live(key) for key in args]
+        if name == 'DEL':
+            return sum(self.data.pop(key, None) is not None for key in args)
+        if name in ('INCR', 'INCRBY'):
+            amount = int(args[1]) if name == 'INCRBY' else 1
+            self.data[args[0]] = str(int(self._live(args[0]) or 0) + amount)
+            return int(self.data[args[0]])
+        if name == 'EXPIRE':
+            self.expiry[args[0]] = time.time() + int(args[1])
+            return 1
+        if name == 'HGET':
+            return (self._live(args[0]) or {}).get(args[1])
+        if name == 'HGETALL':
+            flat = []
+            for field, value in (self._live(args[0]) or {}).items():
+                flat.extend([field, value])
+            return flat
+        if name == 'HSET':
+            table = self.data.setdefault(args[0], {})
+            added = 0
+            for field, value in zip(args[1::2], args[2::2]):
+                added += field not in table
+                table[field] = value
+            return added
+        if name == 'HDEL':
+            table = self._live(args[0]) or {}
+            return sum(table.pop(field, None) is not None for field in args[1:])
+        if name == 'HINCRBY':
+            table = self.data.setdefault(args[0], {})
+            table[args[1]] = str(int(table.get(args[1], 0)) + int(args[2]))
+            return int(table[args[1]])
+        raise ValueError(f"Unsupported command {name}")
+
+    async def _handle(self, request: Request):
+        command = await request.json()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        base64_encoding = request.headers.get('upstash-encoding') == 'base64'
+        try:
+            result = self.execute(command)
+        except Exception as exc:
+            return JSONResponse({'error': str(exc)}, status_code=400)
+        return JSONResponse({'result': self._encode(result, base64_encoding)})
+
+    async def _handle_pipeline(self, request: Request):
+        commands = await request.json()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        base64_encoding = request.headers.get('upstash-encoding') == 'base64'
+        replies = []
+        for command in commands:
+            try:
+                replies.append({'result': self._encode(self.execute(command), base64_encoding)})
+            except Exception as exc:
+                replies.append({'error': str(exc)})
+        return JSONResponse(replies)
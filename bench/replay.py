@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Replay captured webhook traffic into the FastAPI app in-process
+
+Reads files written with WEBHOOK_CAPTURE_FILE (rotated backups included,
+oldest first) and POSTs every body to api/bot.py through ASGI. Telegram and
+Upstash are replaced by the local fakes from bench/fakes.py, so no request
+leaves the machine.
+
+    python bench/replay.py captures/webhooks.jsonl.gz              # original speed
+    python bench/replay.py captures/webhooks.jsonl.gz --speed 4    # 4x faster
+    python bench/replay.py captures/webhooks.jsonl.gz --max-rate   # as fast as possible
+
+At original or Nx speed requests are sent at their (scaled) capture times
+whether or not earlier ones have finished, like real traffic; lag reports
+how far behind schedule the sender fell. --max-rate keeps --concurrency
+requests in flight instead.
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+from datetime import datetime
+
+from fakes import FakeTelegram, FakeUpstash, LocalServer
+from run import (
+    configure_environment, percentile, previous_result, print_report, save_result, seed_library, summarize,
+)
+# Importing run put the repo root on sys.path
+from capture import capture_files, read_capture
+
+
+def update_kind(body: str) -> str:
+    """Coarse update type used to break latencies down."""
+    for field, kind in (('inline_query', 'inline'), ('chosen_inline_result', 'chosen'),
+                        ('callback_query', 'callback'), ('edited_message', 'edited')):
+        if f'"{field}"' in body:
+            return kind
+    if '"message"' in body:
+        if '"video"' in body:
+            return 'upload'
+        return 'command' if '"bot_command"' in body else 'message'
+    return 'other'
+
+
+def load_records(paths, limit=None):
+    records = []
+    for record in read_capture(paths):
+        records.append(record)
+        if limit and len(records) >= limit:
+            break
+    return records
+
+
+async def drive_replay(records, speed, concurrency):
+    """POST every record to the app; returns (latencies by kind, errors, wall, cold ms, lags in ms)."""
+    import httpx
+    import api.bot as api_module
+
+    latencies = {}
+    lags = []
+    errors = 0
+    headers = {'Content-Type': 'application/json'}
+    secret = os.getenv('WEBHOOK_SECRET')
+    if secret:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = secret
+    transport = httpx.ASGITransport(app=api_module.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://replay') as client:
+        async def send(record):
+            nonlocal errors
+            start = time.perf_counter()
+            response = await client.post(record.get('path') or '/api/bot', content=record['body'], headers=headers)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if response.status_code != 200:
+                errors += 1
+            latencies.setdefault(update_kind(record['body']), []).append(elapsed_ms)
+
+        # The first request pays for the cold start; report it separately
+        cold_start = time.perf_counter()
+        await send(records[0])
+        cold_ms = (time.perf_counter() - cold_start) * 1000
+        latencies.clear()
+
+        started = time.perf_counter()
+        if speed is None:
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def bounded(record):
+                async with semaphore:
+                    await send(record)
+
+            await asyncio.gather(*(bounded(record) for record in records[1:]))
+        else:
+            first_ts = records[0]['ts']
+            tasks = []
+            for record in records[1:]:
+                due = (record['ts'] - first_ts) / speed
+                delay = due - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                lags.append(max(0.0, -delay) * 1000)
+                tasks.append(asyncio.ensure_future(send(record)))
+            await asyncio.gather(*tasks)
+        wall = time.perf_counter() - started
+    await api_module.bot_module.state_store.close()
+    return latencies, errors, wall, cold_ms, lags
+
+
+async def run_replay(args, records):
+    telegram_fake = FakeTelegram(args.telegram_latency_ms / 1000)
+    upstash_fake = FakeUpstash(args.redis_latency_ms / 1000)
+    if args.library_size:
+        seed_library(upstash_fake, args.library_size, random.Random(args.seed))
+    telegram = LocalServer(telegram_fake.app)
+    upstash = LocalServer(upstash_fake.app)
+    await telegram.start()
+    await upstash.start()
+    configure_environment(telegram, upstash)
+    # Never capture the replay itself
+    os.environ.pop('WEBHOOK_CAPTURE_FILE', None)
+    try:
+        latencies, errors, wall, cold_ms, lags = await drive_replay(
+            records, None if args.max_rate else args.speed, args.concurrency)
+    finally:
+        await telegram.stop()
+        await upstash.stop()
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    lags.sort()
+    return {
+        'mode': 'replay',
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'config': {
+            'capture': [os.path.basename(path) for path in args.paths],
+            'updates': len(records),
+            'speed': 'max' if args.max_rate else args.speed,
+            'concurrency': args.concurrency if args.max_rate else None,
+            'telegram_latency_ms': args.telegram_latency_ms,
+            'redis_latency_ms': args.redis_latency_ms,
+            'library_size': args.library_size,
+        },
+        'cold_start_ms': round(cold_ms, 3),
+        'errors': errors,
+        'updates_per_sec': round(len(all_latencies) / wall, 1) if wall else None,
+        'captured_span_s': round(records[-1]['ts'] - records[0]['ts'], 3),
+        'wall_s': round(wall, 3),
+        'lag_p99_ms': round(percentile(lags, 99), 3) if lags else None,
+        'overall': summarize(all_latencies),
+        'by_kind': {kind: summarize(values) for kind, values in sorted(latencies.items())},
+        'telegram_calls': dict(telegram_fake.calls),
+        'redis_commands': dict(upstash_fake.commands),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Replay captured webhook traffic against local fakes')
+    parser.add_argument('capture', nargs='+',
+                        help='capture file(s); rotated backups of each (file.1, file.2, ...) are included')
+    pacing = parser.add_mutually_exclusive_group()
+    pacing.add_argument('--speed', type=float, default=1.0, help='time scale: 1 = as captured, 4 = 4x faster')
+    pacing.add_argument('--max-rate', action='store_true', help='ignore capture timing; keep --concurrency in flight')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--limit', type=int, help='replay at most this many requests')
+    parser.add_argument('--telegram-latency-ms', type=float, default=30.0)
+    parser.add_argument('--redis-latency-ms', type=float, default=10.0)
+    parser.add_argument('--library-size', type=int, default=1000, help='videos seeded into the fake Redis')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-save', action='store_true', help="don't write bench/results/")
+    args = parser.parse_args(argv)
+    if args.speed <= 0:
+        parser.error('--speed must be positive')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    args.paths = [path for name in args.capture for path in capture_files(name)]
+    records = load_records(args.paths, args.limit)
+    if not records:
+        print('no captured requests found')
+        sys.exit(1)
+    result = asyncio.run(run_replay(args, records))
+    previous = previous_result('replay')
+    print_report(result, previous)
+    print(f"captured span {result['captured_span_s']}s replayed in {result['wall_s']}s"
+          + (f", sender lag p99 {result['lag_p99_ms']}ms" if result['lag_p99_ms'] is not None else ''))
+    if not args.no_save:
+        print(f"saved {save_result(result)}")
+    sys.exit(1 if result['errors'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark against local fake Telegram and Upstash servers
+
+Drives either the FastAPI webhook app (api/bot.py) or the polling
+Application (bot.py) with a synthetic mix of inline queries, commands and
+video uploads, then reports latency percentiles and updates/sec. Results are
+saved under bench/results/ and compared with the previous run of the same
+mode so regressions show up between runs.
+
+    python bench/run.py --mode all --updates 2000 --telegram-latency-ms 30
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+sys.path.insert(0, ROOT)
+
+from fakes import BOT_USER, FakeTelegram, FakeUpstash, LocalServer  # noqa: E402
+
+TOKEN = f"{BOT_USER['id']}:bench"
+OWNER_ID = 1
+WORDS = (
+    'cat dog funny meme dance fail win music party rain sunset city car train '
+    'beach snow game goal kitten puppy bird fox wolf bear fish baby cake'
+).split()
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies_ms):
+    values = sorted(latencies_ms)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 50), 3),
+        'p95_ms': round(percentile(values, 95), 3),
+        'p99_ms': round(percentile(values, 99), 3),
+        'mean_ms': round(sum(values) / len(values), 3),
+        'max_ms': round(values[-1], 3),
+    }
+
+
+# Workload ------------------------------------------------------------------
+
+def seed_library(upstash: FakeUpstash, size: int, rng: random.Random):
+    """Pre-populate the fake Redis with a shared library and some users' own videos."""
+    videos = {}
+    for i in range(size):
+        words = rng.sample(WORDS, 3)
+        videos[f"seed{i}"] = json.dumps({
+            'file_id': f"SEEDFILE{i}",
+            'title': ' '.join(words[:2]),
+            'tags': [words[2]],
+            'caption': ' '.join(words) + f" #{words[2]}",
+            'added_at': float(i),
+        })
+    upstash.data['videos'] = videos
+    # Every tenth user also has a few videos of their own
+    personal = {}
+    for user_id in range(2, 501, 10):
+        entries = {}
+        for i in range(3):
+            words = rng.sample(WORDS, 2)
+            entries[f"own{user_id}_{i}"] = {
+                'file_id': f"OWNFILE{user_id}_{i}", 'title': ' '.join(words),
+                'tags': [], 'caption': '', 'added_at': float(i),
+            }
+        personal[str(user_id)] = json.dumps(entries)
+    upstash.data['user_videos'] = personal
+
+
+def make_updates(count: int, rng: random.Random, inline_share: float, upload_share: float):
+    """Synthetic updates as (kind, update dict). Message chats are unique per update."""
+    updates = []
+    for i in range(count):
+        update_id = 1000 + i
+        user_id = rng.randint(2, 500)
+        user = {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"}
+        roll = rng.random()
+        if roll < inline_share:
+            query = ' '.join(rng.sample(WORDS, rng.choice((0, 1, 1, 2))))
+            if query and rng.random() < 0.3:
+                query = query[:rng.randint(1, len(query))]
+            updates.append(('inline', {
+                'update_id': update_id,
+                'inline_query': {
+                    'id': f"iq{update_id}", 'from': user, 'query': query,
+                    'offset': rng.choice(('', '', '', '20')), 'chat_type': rng.choice(('private', 'group')),
+                },
+            }))
+            continue
+        chat = {'id': 10_000_000 + update_id, 'type': 'private'}
+        message = {'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'from': user}
+        if roll < inline_share + upload_share:
+            message['from'] = {'id': OWNER_ID, 'is_bot': False, 'first_name': 'owner'}
+            message['video'] = {
+                'file_id': f"FILE{update_id}", 'file_unique_id': f"U{update_id}",
+                'width': 640, 'height': 360, 'duration': rng.randint(1, 60),
+            }
+            message['caption'] = ' '.join(rng.sample(WORDS, 3)) + f" #{rng.choice(WORDS)}"
+            updates.append(('upload', {'update_id': update_id, 'message': message}))
+        else:
+            command = rng.choice(('/start', '/status'))
+            message['text'] = command
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+            updates.append(('command', {'update_id': update_id, 'message': message}))
+    return updates
+
+
+def configure_environment(telegram: LocalServer, upstash: LocalServer):
+    """Point the bot at the fakes; must run before bot/api.bot are imported."""
+    os.environ.update({
+        'BOT_TOKEN': TOKEN,
+        'OWNER_ID': str(OWNER_ID),
+        'UPSTASH_REDIS_REST_URL': upstash.url,
+        'UPSTASH_REDIS_REST_TOKEN': 'bench',
+        'TELEGRAM_API_BASE_URL': f"{telegram.url}/bot",
+        'STATE_BACKEND': 'redis',
+    })
+
+
+# Drivers -------------------------------------------------------------------
+
+async def drive_webhook(updates, concurrency):
+    """POST every update to the FastAPI app in-process; latency is the webhook response time."""
+    import httpx
+    import api.bot as api_module
+
+    latencies = {}
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=api_module.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        async def send(kind, update):
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post('/api/bot', json=update)
+                elapsed_ms = (time.perf_counter() - start) * 1000
+            if response.status_code != 200:
+                errors += 1
+            latencies.setdefault(kind, []).append(elapsed_ms)
+
+        # The first update pays for the cold start; report it separately
+        cold_start = time.perf_counter()
+        await send(*updates[0])
+        cold_ms = (time.perf_counter() - cold_start) * 1000
+        latencies.clear()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send(kind, update) for kind, update in updates[1:]))
+        wall = time.perf_counter() - started
+    # Release the pooled Redis session before the fakes go away
+    await api_module.bot_module.state_store.close()
+    return latencies, errors, wall, cold_ms
+
+
+async def drive_polling(updates, concurrency, telegram_fake):
+    """Feed updates into the polling Application's queue.
+
+    Latency is measured until the fake Telegram receives the reply
+    (answerInlineQuery or sendMessage) for that update.
+    """
+    from telegram import Update
+    import bot as bot_module
+
+    pending = {}
+
+    def on_call(method, params):
+        if method == 'answerInlineQuery':
+            key = params.get('inline_query_id')
+        elif method == 'sendMessage':
+            key = params.get('chat_id')
+        else:
+            return
+        waiter = pending.pop(str(key), None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(time.perf_counter())
+
+    telegram_fake.on_call = on_call
+    application = bot_module.build_application(TOKEN, post_init=bot_module._post_init)
+    cold_start = time.perf_counter()
+    await application.initialize()
+    await bot_module._post_init(application)
+    await application.start()
+    cold_ms = (time.perf_counter() - cold_start) * 1000
+
+    latencies = {}
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+
+    async def send(kind, data):
+        nonlocal errors
+        async with semaphore:
+            if 'inline_query' in data:
+                key = data['inline_query']['id']
+            else:
+                key = str(data['message']['chat']['id'])
+            waiter = pending[key] = loop.create_future()
+            start = time.perf_counter()
+            await application.update_queue.put(Update.de_json(data, application.bot))
+            try:
+                done_at = await asyncio.wait_for(waiter, timeout=30)
+            except asyncio.TimeoutError:
+                errors += 1
+                return
+            latencies.setdefault(kind, []).append((done_at - start) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send(kind, update) for kind, update in updates))
+    wall = time.perf_counter() - started
+    await application.stop()
+    await bot_module.state_store.close()
+    await application.shutdown()
+    return latencies, errors, wall, cold_ms
+
+
+# Reporting -----------------------------------------------------------------
+
+def build_result(mode, args, latencies, errors, wall, cold_ms, telegram_fake, upstash_fake):
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        'mode': mode,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'config': {
+            'updates': args.updates,
+            'concurrency': args.concurrency,
+            'telegram_latency_ms': args.telegram_latency_ms,
+            'redis_latency_ms': args.redis_latency_ms,
+            'library_size': args.library_size,
+            'seed': args.seed,
+        },
+        'cold_start_ms': round(cold_ms, 3),
+        'errors': errors,
+        'updates_per_sec': round(len(all_latencies) / wall, 1) if wall else None,
+        'overall': summarize(all_latencies),
+        'by_kind': {kind: summarize(values) for kind, values in sorted(latencies.items())},
+        'telegram_calls': dict(telegram_fake.calls),
+        'redis_commands': dict(upstash_fake.commands),
+    }
+
+
+def previous_result(mode):
+    if not os.path.isdir(RESULTS_DIR):
+        return None
+    names = sorted(n for n in os.listdir(RESULTS_DIR) if n.startswith(f"{mode}-") and n.endswith('.json'))
+    if not names:
+        return None
+    with open(os.path.join(RESULTS_DIR, names[-1]), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_result(result):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(RESULTS_DIR, f"{result['mode']}-{stamp}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(result, f, indent=2)
+    return path
+
+
+def _delta(new, old):
+    if new is None or not old:
+        return ''
+    return f" ({(new - old) / old * 100:+.1f}%)"
+
+
+def print_report(result, previous):
+    overall = result['overall']
+    prev_overall = (previous or {}).get('overall', {})
+    print(f"\n== {result['mode']} == {result['overall'].get('count', 0)} updates, "
+          f"{result['errors']} errors, cold start {result['cold_start_ms']:.1f}ms")
+    print(f"throughput: {result['updates_per_sec']} updates/s"
+          f"{_delta(result['updates_per_sec'], (previous or {}).get('updates_per_sec'))}")
+    for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+        if key in overall:
+            print(f"{key[:-3]:>4}: {overall[key]:8.2f}ms{_delta(overall[key], prev_overall.get(key))}")
+    for kind, stats in result['by_kind'].items():
+        print(f"  {kind:<8} n={stats['count']:<6} p50={stats['p50_ms']:.2f}ms "
+              f"p95={stats['p95_ms']:.2f}ms p99={stats['p99_ms']:.2f}ms")
+    if previous and previous.get('config') != result['config']:
+        print("  (previous run used a different config; deltas are indicative only)")
+
+
+def regressed(result, previous, threshold_pct):
+    """True if p95 got worse than the previous run by more than threshold_pct."""
+    if not previous or previous.get('config') != result['config']:
+        return False
+    old = previous.get('overall', {}).get('p95_ms')
+    new = result['overall'].get('p95_ms')
+    return bool(old and new and (new - old) / old * 100 > threshold_pct)
+
+
+# Entry point ---------------------------------------------------------------
+
+async def run_mode(mode, args):
+    rng = random.Random(args.seed)
+    telegram_fake = FakeTelegram(args.telegram_latency_ms / 1000)
+    upstash_fake = FakeUpstash(args.redis_latency_ms / 1000)
+    seed_library(upstash_fake, args.library_size, rng)
+    telegram = LocalServer(telegram_fake.app)
+    upstash = LocalServer(upstash_fake.app)
+    await telegram.start()
+    await upstash.start()
+    configure_environment(telegram, upstash)
+    updates = make_updates(args.updates, rng, args.inline_share, args.upload_share)
+    try:
+        if mode == 'webhook':
+            outcome = await drive_webhook(updates, args.concurrency)
+        else:
+            outcome = await drive_polling(updates, args.concurrency, telegram_fake)
+    finally:
+        await telegram.stop()
+        await upstash.stop()
+    return build_result(mode, args, *outcome, telegram_fake, upstash_fake)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='End-to-end bot benchmark against local fakes')
+    parser.add_argument('--mode', choices=('webhook', 'polling', 'all'), default='all')
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--telegram-latency-ms', type=float, default=30.0)
+    parser.add_argument('--redis-latency-ms', type=float, default=10.0)
+    parser.add_argument('--library-size', type=int, default=1000)
+    parser.add_argument('--inline-share', type=float, default=0.8)
+    parser.add_argument('--upload-share', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-save', action='store_true', help="don't write bench/results/")
+    parser.add_argument('--fail-on-regression', type=float, metavar='PCT',
+                        help='exit 1 if p95 is more than PCT%% worse than the previous run')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.mode == 'all':
+        # Each mode imports the bot modules with its own environment, so run
+        # them in separate interpreters
+        argv = list(sys.argv[1:] if argv is None else argv)
+        status = 0
+        for mode in ('webhook', 'polling'):
+            status |= subprocess.call([sys.executable, __file__, *argv, '--mode', mode])
+        sys.exit(status)
+
+    result = asyncio.run(run_mode(args.mode, args))
+    previous = previous_result(args.mode)
+    print_report(result, previous)
+    if not args.no_save:
+        print(f"saved {save_result(result)}")
+    if args.fail_on_regression is not None and regressed(result, previous, args.fail_on_regression):
+        print(f"FAIL: p95 regressed by more than {args.fail_on_regression}%")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,237 +1,626 @@
 #!/usr/bin/env python3
 """
 Simple Video Sending Bot
+
+python-telegram-bot is imported lazily (see build_application) so the webhook
+can answer fast-path updates on a cold start without loading it.
 """
 
+from __future__ import annotations
+
 import os
-import json
 import logging
 import time
 import hashlib
+import asyncio
+from itertools import islice
+from typing import TYPE_CHECKING
 from dotenv import load_dotenv
-from telegram import Update, InlineQueryResultVideo, InputTextMessageContent, InputFile, InlineQueryResultCachedVideo, InlineQueryResultArticle
-from telegram.ext import Application, CommandHandler, MessageHandler, InlineQueryHandler, filters
-from telegram.error import NetworkError
-
-# Optional durable KV (Upstash Redis)
-REDIS_URL = os.getenv('UPSTASH_REDIS_REST_URL')
-REDIS_TOKEN = os.getenv('UPSTASH_REDIS_REST_TOKEN')
-redis_client = None
-if REDIS_URL and REDIS_TOKEN:
-    try:
-        from upstash_redis import Redis
-        redis_client = Redis(url=REDIS_URL, token=REDIS_TOKEN)
-    except Exception as exc:
-        # If client fails to init, fall back to JSON
-        redis_client = None
-        logging.getLogger(__name__).error(f"Failed to init Redis client: {exc}")
+
+import metrics
+from ingest import INGESTED, IngestBatcher, dedupe, entry_from_message, is_batched
+from library import VideoEntry, VideoLibrary, search_page, tokenize
+from popularity import PopularityCounter
+from result_cache import InlineResultCache
+from state_store import create_state_store
+from user_libraries import UserLibraries
+
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import Application, ContextTypes
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging (avoid file writes on serverless read-only FS)
-handlers_list = [logging.StreamHandler()]
-try:
-    handlers_list.append(logging.FileHandler('bot.log'))
-except OSError:
-    # Read-only FS (e.g., Vercel). Skip file logging.
-    pass
-
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.WARNING,
-    handlers=handlers_list
-)
 logger = logging.getLogger(__name__)
-# Suppress noisy third-party loggers
-logging.getLogger("httpx").setLevel(logging.ERROR)
-logging.getLogger("telegram").setLevel(logging.WARNING)
 
-# Global variable to store the video
-stored_video = None
+def configure_logging():
+    """Configure logging for polling mode; bot.log is written off the event loop."""
+    import logging_setup
+    logging_setup.configure('bot.log')
+
+# Shared library of stored videos, searchable from inline mode by everyone
+library = VideoLibrary()
 
-# Owner user id (only owner can set/clear video)
+# Owner user id (only the owner manages the shared library; everyone else
+# stores videos in their own library)
 OWNER_ID_STR = os.getenv('OWNER_ID')
 OWNER_ID = int(OWNER_ID_STR) if OWNER_ID_STR and OWNER_ID_STR.isdigit() else None
 
-STATE_FILE_PATH = 'state.json'
+# Local state files: state.snapshot and state.log (used without Redis)
+STATE_PATH = 'state'
+# State store hash holding one field per stored video
+LIBRARY_KEY = 'videos'
+# State store hash holding one field per user: that user's own videos
+USER_LIBRARIES_KEY = 'user_videos'
+# State store hash counting how often each video was chosen inline
+POPULARITY_KEY = 'popularity'
+# Single video kept by versions before the library (migrated on load)
+LEGACY_VIDEO_KEY = 'stored_video'
+# Cached getMe result, so a cold start does not need the round-trip
+IDENTITY_KEY = 'bot_identity'
+# Inline results per page (Telegram allows at most 50)
+INLINE_PAGE_SIZE = 20
+# Users are hashed into this many buckets for result ids (bounds the answer cache)
+INLINE_USER_BUCKETS = int(os.getenv('INLINE_USER_BUCKETS', '16'))
 
-def load_state():
-    """Load stored state from disk into memory."""
-    global stored_video
-    # Prefer Redis if available
-    if redis_client is not None:
-        try:
-            value = redis_client.get('stored_video')
-            if isinstance(value, bytes):
-                value = value.decode('utf-8')
-            stored_video_local = value if value not in (None, "") else None
-            stored_video = stored_video_local
-            logger.info("State loaded from Redis")
-            return
-        except Exception as exc:
-            logger.error(f"Failed to load state from Redis: {exc}")
-    # Fallback to JSON file
+# Prebuilt inline answers, reused until the library changes
+inline_cache = InlineResultCache(int(os.getenv('INLINE_CACHE_SIZE', '1024')))
+
+metrics.CallbackMetric(
+    'bot_inline_cache_hits_total', 'Inline answers served from the cache',
+    lambda: inline_cache.hits, kind='counter')
+metrics.CallbackMetric(
+    'bot_inline_cache_misses_total', 'Inline answers built from the library',
+    lambda: inline_cache.misses, kind='counter')
+metrics.CallbackMetric(
+    'bot_library_videos', 'Videos in the in-memory library', lambda: len(library))
+
+# How often an instance checks whether another instance changed the state
+STATE_REVALIDATE_SECONDS = float(os.getenv('STATE_REVALIDATE_SECONDS', '10'))
+
+# Durable state (Upstash Redis if configured, else a local log), flushed in the background
+state_store = create_state_store(STATE_PATH)
+
+# Users' own libraries, loaded on demand and bounded by USER_CACHE_MB; each
+# user's entry is revalidated on its own, as user writes don't bump the state version
+user_libraries = UserLibraries(
+    state_store, USER_LIBRARIES_KEY, int(float(os.getenv('USER_CACHE_MB', '32')) * 1024 * 1024),
+    revalidate=STATE_REVALIDATE_SECONDS,
+)
+
+metrics.CallbackMetric(
+    'bot_user_cache_bytes', 'Estimated memory held by cached user libraries',
+    lambda: user_libraries.bytes)
+metrics.CallbackMetric(
+    'bot_user_cache_users', 'Users with a cached library (or cached absence of one)',
+    lambda: len(user_libraries))
+metrics.CallbackMetric(
+    'bot_user_cache_lookups_total', 'User library lookups by result',
+    lambda: {('hit',): user_libraries.hits, ('miss',): user_libraries.misses},
+    labelnames=('result',), kind='counter')
+metrics.CallbackMetric(
+    'bot_user_cache_evictions_total', 'User libraries evicted to stay within the byte budget',
+    lambda: user_libraries.evictions, kind='counter')
+
+# Chosen inline results, used to rank search results; flushed in batches
+popularity = PopularityCounter(
+    state_store, POPULARITY_KEY, float(os.getenv('POPULARITY_FLUSH_SECONDS', '5'))
+)
+
+# Bot identity ({'id', 'username', ...}) from the state store or the last getMe
+bot_identity = None
+
+# True once load_state() has succeeded; until then only a placeholder can be served
+state_loaded = False
+
+# Last state version check (see STATE_REVALIDATE_SECONDS)
+_last_revalidated = time.monotonic()
+_revalidate_task = None
+
+def bot_username():
+    """The bot's username if known without a network call, else None."""
+    return bot_identity.get('username') if bot_identity else None
+
+def remember_bot_identity(user):
+    """Cache the bot's User (from getMe) in memory and in the state store."""
+    global bot_identity
+    from bot_identity import identity_from_user
+    identity = identity_from_user(user)
+    if identity != bot_identity:
+        bot_identity = identity
+        state_store.set(IDENTITY_KEY, identity)
+
+# The shared library hash as last applied to library, to spot changed entries cheaply
+_applied_library = {}
+
+def _apply_stored_library(stored):
+    """Bring the shared library in line with its stored hash.
+
+    Only entries that were added, changed or removed are (re)indexed, so a
+    reload after another instance stored one video costs about as much as
+    that video; the library keeps its version when nothing changed.
+    """
+    global _applied_library
+    for entry_id in [entry.id for entry in library.recent() if entry.id not in stored]:
+        library.remove(entry_id)
+    changed = []
+    for entry_id, data in stored.items():
+        existing = library.get(entry_id)
+        if existing is not None and _applied_library.get(entry_id) == data:
+            continue
+        entry = VideoEntry.from_dict(entry_id, data)
+        # Entries stored by this instance are in library but not in _applied_library
+        if existing is None or existing.to_dict() != entry.to_dict():
+            changed.append(entry)
+    for entry in sorted(changed, key=lambda e: e.added_at):
+        library.add(entry)
+    _applied_library = dict(stored)
+
+async def load_state():
+    """Load the stored video library (and cached bot identity) into memory."""
+    global bot_identity, state_loaded
     try:
-        if os.path.exists(STATE_FILE_PATH):
-            with open(STATE_FILE_PATH, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                stored_video = data.get('stored_video')
-                logger.info("State loaded from disk")
+        # Record the version first so writes racing with this load are noticed later
+        await state_store.refresh_version()
+        # The legacy key is read alongside the rest, not in a later round-trip
+        stored, bot_identity, chosen, legacy_video = await asyncio.gather(
+            state_store.hgetall(LIBRARY_KEY),
+            state_store.get(IDENTITY_KEY),
+            state_store.hgetall(POPULARITY_KEY),
+            state_store.get(LEGACY_VIDEO_KEY),
+        )
+        popularity.load(chosen)
+        _apply_stored_library(stored)
+        # Migrate the single video kept by older versions
+        if legacy_video:
+            if not any(entry.file_id == legacy_video for entry in library.recent()):
+                entry = VideoEntry('legacy', legacy_video, 'Stored video')
+                library.add(entry)
+                save_state(added=[entry])
+            state_store.delete(LEGACY_VIDEO_KEY)
+        state_loaded = True
+        logger.info("State loaded (%d videos)", len(library))
     except Exception as exc:
-        logger.error(f"Failed to load state: {exc}")
+        logger.error("Failed to load state: %s", exc)
 
-def save_state():
-    """Persist current state to disk."""
-    # Prefer Redis if available
-    if redis_client is not None:
-        try:
-            # Store empty string to represent None
-            value = stored_video if stored_video is not None else ""
-            redis_client.set('stored_video', value)
-            logger.info("State saved to Redis")
-            return
-        except Exception as exc:
-            logger.error(f"Failed to save state to Redis: {exc}")
-    # Fallback to JSON file (may be ephemeral in serverless)
+async def revalidate_state(force=False):
+    """Reload state if another instance changed it; True if it was reloaded.
+
+    Costs one version read per STATE_REVALIDATE_SECONDS (or per call when
+    forced, e.g. from warm pings); the full state is only re-fetched when the
+    version moved, or if it was never loaded successfully.
+    """
+    global _last_revalidated
+    now = time.monotonic()
+    if not force and now - _last_revalidated < STATE_REVALIDATE_SECONDS:
+        return False
+    _last_revalidated = now
+    if not state_loaded:
+        # The initial load failed; retry it rather than comparing versions
+        await load_state()
+        return state_loaded
     try:
-        with open(STATE_FILE_PATH, 'w', encoding='utf-8') as f:
-            json.dump({'stored_video': stored_video}, f)
-        logger.info("State saved to disk")
+        if not await state_store.refresh_version():
+            return False
     except Exception as exc:
-        logger.error(f"Failed to save state: {exc}")
+        logger.error("Failed to check state version: %s", exc)
+        return False
+    state_store.invalidate()
+    await load_state()
+    logger.info("State changed on another instance; reloaded")
+    return True
 
+def schedule_revalidation():
+    """Start a background revalidation if the TTL expired, without blocking the caller."""
+    global _revalidate_task
+    if time.monotonic() - _last_revalidated < STATE_REVALIDATE_SECONDS:
+        return
+    if _revalidate_task is not None and not _revalidate_task.done():
+        return
+    _revalidate_task = asyncio.get_running_loop().create_task(revalidate_state())
+
+def save_state(added=(), removed=(), cleared=False):
+    """Queue shared library changes for persistence; the store flushes them in the background."""
+    if cleared:
+        state_store.delete(LIBRARY_KEY)
+    for entry_id in removed:
+        state_store.hdel(LIBRARY_KEY, entry_id)
+    for entry in added:
+        state_store.hset(LIBRARY_KEY, entry.id, entry.to_dict())
+
+def is_owner(user_id):
+    """True if user_id manages the shared library."""
+    return OWNER_ID is not None and user_id == OWNER_ID
+
+async def personal_library(user_id):
+    """The user's own non-empty library, or None (always None for the owner).
+
+    Read failures are logged and treated as "no videos" so inline answers
+    still go out with the shared library.
+    """
+    if not user_id or is_owner(user_id):
+        return None
+    try:
+        personal = await user_libraries.get(user_id)
+    except Exception as exc:
+        logger.error("Failed to load videos of user %s: %s", user_id, exc)
+        return None
+    return personal if personal else None
+
+async def managed_library(user_id):
+    """The library a user's uploads and /clear act on: shared for the owner, else their own."""
+    if is_owner(user_id):
+        return library
+    # The whole library is written back, so start from the stored version
+    return await user_libraries.get_current(user_id) or VideoLibrary()
+
+def save_library(user_id, target, added=(), removed=(), cleared=False):
+    """Persist changes made to the library returned by managed_library()."""
+    if target is library:
+        save_state(added=added, removed=removed, cleared=cleared)
+    else:
+        user_libraries.save(user_id, target)
+
+def start_text():
+    """Reply text for /start."""
+    return (
+        "👋 Hi! Send me a video to store it, then use @nihuyaNeUnderstandBot in any chat to send it!\n"
+        "Add a caption to give it a title and #tags, then search with @nihuyaNeUnderstandBot <words>."
+    )
+
+@metrics.instrument_handler
 async def start(update: Update, context):
     """Handle /start command."""
-    await update.message.reply_text(
-        "👋 Hi! Send me a video to store it, then use @nihuyaNeUnderstandBot in any chat to send it!"
+    await update.message.reply_text(start_text())
+
+def _ingest_reply(target, added, duplicates, bot_username):
+    """Reply text for a stored batch of videos."""
+    where = "library" if target is library else "your library"
+    if len(added) == 1 and not duplicates:
+        return (
+            f"✅ Video stored as “{added[0].title}” ({len(target)} in {where}). "
+            f"Use @{bot_username} in any chat to send it."
+        )
+    if not added:
+        if len(duplicates) == 1:
+            existing = target.get(duplicates[0].id) or duplicates[0]
+            return f"ℹ️ This video is already stored as “{existing.title}”."
+        return f"ℹ️ All {len(duplicates)} videos were already stored."
+    skipped = f", skipped {len(duplicates)} already stored" if duplicates else ""
+    return (
+        f"✅ Stored {len(added)} videos{skipped} ({len(target)} in {where}). "
+        f"Use @{bot_username} in any chat to send them."
     )
 
+async def store_batch(batch, reply=True):
+    """Store a batch of received videos with a single write and tell the user.
+
+    Videos are deduplicated by file_unique_id (the entry id), within the
+    batch and against the library they go to. Returns (added, duplicates).
+    """
+    target = await managed_library(batch.user_id)
+    added, duplicates = dedupe(target, batch.entries)
+    for entry in added:
+        target.add(entry)
+    if added:
+        save_library(batch.user_id, target, added=added)
+    INGESTED.inc('stored', amount=len(added))
+    INGESTED.inc('duplicate', amount=len(duplicates))
+    logger.info("Stored %d videos (%d duplicates) in %s", len(added), len(duplicates),
+                "shared library" if target is library else "user library")
+    if reply:
+        await batch.bot.send_message(batch.chat_id, _ingest_reply(target, added, duplicates, batch.bot.username))
+    return added, duplicates
+
+# Albums, forwarded videos and /import sessions are stored in batches
+ingest_batcher = IngestBatcher(
+    store_batch,
+    window=float(os.getenv('INGEST_BATCH_SECONDS', '1.5')),
+    max_items=int(os.getenv('INGEST_MAX_BATCH', '200')),
+)
+
+@metrics.instrument_handler
 async def store_video_handler(update: Update, context):
-    """Store the video sent by user."""
-    global stored_video
-    # Owner-only guard
-    if OWNER_ID is not None:
-        user_id = update.effective_user.id if update.effective_user else None
-        if user_id != OWNER_ID:
-            await update.message.reply_text("❌ Only the owner can update the stored video.")
-            return
-    
-    if not update.message.video:
-        await update.message.reply_text("❌ Please send a video file.")
+    """Store a received video (in the shared library if the sender is the owner)."""
+    message = update.message
+    entry = entry_from_message(message)
+    if entry is None:
+        await message.reply_text("❌ Please send a video file.")
         return
-    
-    stored_video = update.message.video.file_id
-    logger.info("Video stored successfully")
-    save_state()
-    
+    user_id = update.effective_user.id if update.effective_user else None
+    await ingest_batcher.add(user_id, message.chat_id, context.bot, entry, batched=is_batched(message))
+
+@metrics.instrument_handler
+async def import_videos(update: Update, context):
+    """Start collecting many videos (e.g. forwarded from another chat) until /done."""
+    user_id = update.effective_user.id if update.effective_user else None
+    batch = ingest_batcher.start_import(user_id, update.effective_chat.id, context.bot)
+    waiting = f" ({len(batch.entries)} received so far)" if batch.entries else ""
     await update.message.reply_text(
-        f"✅ Video stored! Use @{context.bot.username} in any chat to send it."
+        f"📥 Import started{waiting}. Send or forward the videos now, then send /done to store them all."
     )
 
-async def inline_query_handler(update: Update, context):
-    """Handle inline queries."""
-    global stored_video
-    
-    logger.info("Inline query received")
-    logger.info(f"Inline query - stored video: {stored_video}")
-    logger.info(f"Inline query - stored video type: {type(stored_video)}")
-    logger.info(f"Inline query - stored video is None: {stored_video is None}")
-    _start_inline = time.time()
-    
-    if not stored_video:
+@metrics.instrument_handler
+async def finish_import(update: Update, context):
+    """Store everything received since /import."""
+    user_id = update.effective_user.id if update.effective_user else None
+    if not ingest_batcher.in_import(user_id):
+        if ingest_batcher.immediate:
+            # The import may have started on another instance; its videos are stored already
+            await update.message.reply_text("✅ Videos are stored as they arrive, nothing left to import.")
+        else:
+            await update.message.reply_text("Nothing to import. Send /import first.")
+        return
+    batch = await ingest_batcher.finish(user_id)
+    if batch.stored or batch.skipped:
+        skipped = f", skipped {batch.skipped} already stored" if batch.skipped else ""
+        await update.message.reply_text(f"✅ Import done: stored {batch.stored} videos{skipped}.")
+    elif not batch.entries:
+        await update.message.reply_text("📭 No videos were received, nothing stored.")
+
+# InlineQuery.chat_type values ('' when Telegram does not send one)
+CHAT_TYPES = ('', 'sender', 'private', 'group', 'supergroup', 'channel')
+
+def _result_id_suffix(user_bucket, chat_type):
+    """Per-bucket unique id suffix to avoid client-side dedup across chats."""
+    id_seed = f"{user_bucket}|{chat_type}"
+    return hashlib.sha1(id_seed.encode('utf-8')).hexdigest()[-12:]
+
+def _build_inline_results(query, offset, user_bucket, chat_type, bot_username, personal=None):
+    """Build the JSON-ready results and next_offset for one inline answer.
+
+    Results are plain Bot API dicts (not PTB objects) so the webhook fast path
+    can use them without importing python-telegram-bot. The user's own
+    videos (personal) are listed before the shared library.
+    """
+    libraries = [personal, library] if personal else [library]
+    if not any(len(lib) for lib in libraries):
         # No video stored
         results = [
-            InlineQueryResultVideo(
-                id="no_video",
-                title="No video stored",
-                description="Send a video to the bot first",
-                video_url="https://example.com/placeholder.mp4",
-                mime_type="video/mp4",
-                thumbnail_url="https://example.com/placeholder.jpg",
-                input_message_content=InputTextMessageContent(
-                    message_text=f"❌ No video stored. Send a video to @{context.bot.username} first."
-                )
-            )
+            {
+                "type": "video",
+                "id": "no_video",
+                "title": "No video stored",
+                "description": "Send a video to the bot first",
+                "video_url": "https://example.com/placeholder.mp4",
+                "mime_type": "video/mp4",
+                "thumbnail_url": "https://example.com/placeholder.jpg",
+                "input_message_content": {
+                    "message_text": f"❌ No video stored. Send a video to @{bot_username} first."
+                },
+            }
         ]
-    else:
-        # Video is stored
-        # Build a per-context unique id seed to avoid client-side dedup across chats
+        return results, ''
+    page, next_offset = search_page(libraries, query, offset, INLINE_PAGE_SIZE, popularity.scores)
+    seed_hash = _result_id_suffix(user_bucket, chat_type)
+    results = []
+    for entry in page:
+        if entry.kind == 'document':
+            # Sent as a file: its file_id can only be answered as a document
+            result = {"type": "document", "document_file_id": entry.file_id}
+        else:
+            result = {"type": "video", "video_file_id": entry.file_id}
+        result["id"] = f"{entry.id}_{seed_hash}"
+        result["title"] = entry.title
+        # Metadata stored at ingest, so no file lookups here
+        description = " · ".join(filter(None, (
+            entry.details(), entry.caption or " ".join(f"#{tag}" for tag in entry.tags),
+        )))
+        if description:
+            result["description"] = description
+        results.append(result)
+    if not offset:
+        # Instant lightweight fallback so the client always renders something
+        results.append(
+            {
+                "type": "article",
+                "id": f"fallback_{seed_hash}",
+                "title": "Loading video… tap if it doesn't appear" if page else "No matching videos",
+                "description": "This shows instantly; try again if video is still loading",
+                "input_message_content": {
+                    "message_text": "If the video didn’t load, wait a second and type the bot handle again."
+                },
+            }
+        )
+    return results, next_offset
+
+def get_inline_answer(query, offset, user_id, chat_type, bot_username, personal=None):
+    """Return (results, next_offset) for an inline query, prebuilt and cached per library version.
+
+    personal is the user's own library (see personal_library()); answers that
+    include it are cached per user and its version.
+    """
+    query = " ".join(tokenize(query))
+    user_bucket = (user_id or 0) % INLINE_USER_BUCKETS
+    owner_key = ('user', user_id, personal.version) if personal else user_bucket
+    key = (query, offset or '', chat_type or '', owner_key)
+    return inline_cache.get_or_build(
+        (library.version, popularity.version),
+        key,
+        lambda: _build_inline_results(query, offset, user_bucket, chat_type or '', bot_username, personal),
+    )
+
+# Telegram clients give up on inline answers after a few seconds. Work that
+# is not done within this budget continues in the background while the
+# answer is built from what is already in memory.
+INLINE_BUDGET_MS = float(os.getenv('INLINE_BUDGET_MS', '1500'))
+# Share of the budget that may be spent waiting for state; the rest is for
+# building and sending the answer
+INLINE_WAIT_SHARE = 0.8
+
+INLINE_DEGRADED = metrics.Counter(
+    'bot_inline_degraded_total', 'Inline answers built from in-memory state because the budget ran out',
+    ('reason',))
+INLINE_OVERRUNS = metrics.Counter(
+    'bot_inline_budget_overruns_total', 'Inline answers that took longer than INLINE_BUDGET_MS')
+
+# Served before any state has been loaded; never cached by the client
+LOADING_RESULTS = [
+    {
+        "type": "article",
+        "id": "loading",
+        "title": "Videos are loading…",
+        "description": "Try again in a moment",
+        "input_message_content": {
+            "message_text": "The bot is starting up, try again in a moment."
+        },
+    }
+]
+
+def inline_deadline(started):
+    """perf_counter() time until which an inline query received at started may wait for state."""
+    return started + INLINE_BUDGET_MS * INLINE_WAIT_SHARE / 1000
+
+async def within_deadline(awaitable, deadline):
+    """Await awaitable until deadline. Returns (True, result), or (False, None) if it is not done.
+
+    Work that misses the deadline is not cancelled; it finishes in the background.
+    """
+    task = asyncio.ensure_future(awaitable)
+    if not task.done():
         try:
-            from_user_id = update.inline_query.from_user.id if update.inline_query and update.inline_query.from_user else 0
-            chat_type = getattr(update.inline_query, 'chat_type', '') or ''
-        except Exception:
-            from_user_id = 0
-            chat_type = ''
-        id_seed = f"{stored_video}|{from_user_id}|{chat_type}"
-        seed_hash = hashlib.sha1(id_seed.encode('utf-8')).hexdigest()[-12:]
-        # Add a small time bucket to mitigate Telegram client cache per chat
-        time_bucket = int(time.time() // 3)  # 3-second buckets for aggressive cache busting
-        unique_id = f"vid_{seed_hash}_{time_bucket}"
-        results = [
-            # Put the real video first when available
-            InlineQueryResultCachedVideo(
-                id=unique_id,
-                title="Send stored video",
-                description="Click to send the stored video",
-                video_file_id=stored_video
-            ),
-            # Instant lightweight fallback so the client always renders something
-            InlineQueryResultArticle(
-                id=f"fallback_{int(time.time())}",
-                title="Loading video… tap if it doesn't appear",
-                description="This shows instantly; try again if video is still loading",
-                input_message_content=InputTextMessageContent(
-                    "If the video didn’t load, wait a second and type the bot handle again."
-                ),
-            )
-        ]
+            await asyncio.wait_for(asyncio.shield(task), max(0.0, deadline - time.perf_counter()))
+        except asyncio.TimeoutError:
+            # Retrieve a late failure so it is not reported as never retrieved
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            return False, None
+    return True, task.result()
+
+async def build_inline_answer(query, offset, user_id, chat_type, bot_username, started):
+    """(results, next_offset, degraded) for an inline query received at started (perf_counter).
+
+    Before the state is loaded the shared library in memory (the last
+    known good state) is used, or a placeholder if there is none. The user's
+    own library is left out if it cannot be read within the budget.
+    """
+    if not state_loaded:
+        INLINE_DEGRADED.inc('state_loading')
+        if not len(library):
+            return LOADING_RESULTS, '', True
+        return (*get_inline_answer(query, offset, user_id, chat_type, bot_username), True)
+    done, personal = await within_deadline(personal_library(user_id), inline_deadline(started))
+    if not done:
+        INLINE_DEGRADED.inc('user_library')
+    return (*get_inline_answer(query, offset, user_id, chat_type, bot_username, personal), not done)
+
+def note_inline_latency(started):
+    """Count (and warn about) inline answers that blew their budget."""
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if elapsed_ms > INLINE_BUDGET_MS:
+        INLINE_OVERRUNS.inc()
+        if elapsed_ms > 4000:
+            logger.warning("Slow inline answer: %.0fms (risk of client timeout)", elapsed_ms)
+    return elapsed_ms
+
+@metrics.instrument_handler
+async def inline_query_handler(update: Update, context):
+    """Handle inline queries."""
+    inline_query = update.inline_query
+    logger.info("Inline query received: %r offset=%r", inline_query.query, inline_query.offset)
+    started = time.perf_counter()
     
+    # Serve from memory; check for changes made by other instances in the background
+    schedule_revalidation()
+    from_user_id = inline_query.from_user.id if inline_query.from_user else 0
+    chat_type = getattr(inline_query, 'chat_type', '') or ''
+    results, next_offset, degraded = await build_inline_answer(
+        inline_query.query, inline_query.offset, from_user_id, chat_type, context.bot.username, started
+    )
+    
+    from telegram.error import NetworkError
     try:
-        await update.inline_query.answer(results, cache_time=0, is_personal=True)
-        _elapsed_ms = int((time.time() - _start_inline) * 1000)
-        logger.info(f"Inline answer sent in {_elapsed_ms}ms (has_video={bool(stored_video)})")
-        if _elapsed_ms > 4000:
-            logger.warning(f"Slow inline answer: {_elapsed_ms}ms (risk of client timeout)")
+        await inline_query.answer(results, cache_time=0, is_personal=True, next_offset=next_offset)
+        elapsed_ms = note_inline_latency(started)
+        logger.info("Inline answer sent in %.0fms (%d results%s)",
+                    elapsed_ms, len(results), ", degraded" if degraded else "")
     except NetworkError as exc:
         if "Event loop is closed" in str(exc):
-            _elapsed_ms = int((time.time() - _start_inline) * 1000)
-            logger.warning(f"Inline answer aborted due to shutdown after {_elapsed_ms}ms")
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            logger.warning("Inline answer aborted due to shutdown after %.0fms", elapsed_ms)
             return
         raise
 
+def record_chosen_result(result_id, user_id):
+    """Count a chosen inline result.
+
+    ChosenInlineResult carries no chat type, so it is recovered from the
+    result id suffix, which hashes the user bucket and chat type.
+    """
+    entry_id, _, suffix = (result_id or '').rpartition('_')
+    if not entry_id or entry_id == 'fallback' or result_id == 'no_video':
+        return
+    user_bucket = (user_id or 0) % INLINE_USER_BUCKETS
+    chat_type = next(
+        (ct for ct in CHAT_TYPES if _result_id_suffix(user_bucket, ct) == suffix), 'unknown'
+    )
+    popularity.record(entry_id, chat_type)
+
+@metrics.instrument_handler
+async def chosen_inline_result_handler(update: Update, context):
+    """Count which inline result was sent (needs inline feedback enabled in BotFather)."""
+    chosen = update.chosen_inline_result
+    record_chosen_result(chosen.result_id, chosen.from_user.id if chosen.from_user else 0)
+
+@metrics.instrument_handler
 async def clear_video(update: Update, context):
-    """Clear stored video."""
-    global stored_video
-    # Owner-only guard
-    if OWNER_ID is not None:
-        user_id = update.effective_user.id if update.effective_user else None
-        if user_id != OWNER_ID:
-            await update.message.reply_text("❌ Only the owner can clear the stored video.")
+    """Clear one of the user's videos (/clear <id>) or all of them (/clear).
+
+    The owner clears the shared library.
+    """
+    user_id = update.effective_user.id if update.effective_user else None
+    target = await managed_library(user_id)
+    if context.args:
+        entry = target.remove(context.args[0])
+        if entry is None:
+            await update.message.reply_text("❌ No video with that id.")
             return
-    stored_video = None
-    save_state()
-    await update.message.reply_text("🗑️ Video cleared.")
+        save_library(user_id, target, removed=[entry.id])
+        await update.message.reply_text(f"🗑️ Removed “{entry.title}”.")
+        return
+    target.clear()
+    save_library(user_id, target, cleared=True)
+    await update.message.reply_text("🗑️ All videos cleared.")
 
-async def status(update: Update, context):
-    """Check if video is stored."""
-    global stored_video
-    if stored_video:
-        video_tail = stored_video[-8:] if isinstance(stored_video, str) else ""
+def _recent_lines(target):
+    return [f"• {entry.title} — /clear {entry.id}" for entry in islice(target.recent(), 5)]
+
+def status_text(user_id=None, personal=None):
+    """Reply text for /status: the shared library for the owner, else the user's own videos."""
+    if user_id is None or is_owner(user_id):
+        if not len(library):
+            return "❌ No video stored."
         owner_info = f" (owner {OWNER_ID})" if OWNER_ID is not None else ""
-        await update.message.reply_text(f"✅ Video is stored and ready to send. id…{video_tail}{owner_info}")
+        lines = [f"✅ {len(library)} video(s) stored and ready to send{owner_info}."]
+        lines.extend(_recent_lines(library))
+        return "\n".join(lines)
+    if personal:
+        lines = [f"✅ You have {len(personal)} video(s) stored and ready to send."]
+        lines.extend(_recent_lines(personal))
     else:
-        await update.message.reply_text("❌ No video stored.")
+        lines = ["❌ You have no videos stored yet. Send me one!"]
+    if len(library):
+        lines.append(f"📚 {len(library)} shared video(s) are available too.")
+    return "\n".join(lines)
 
-from telegram.ext import ContextTypes
+@metrics.instrument_handler
+async def status(update: Update, context):
+    """Check which videos are stored."""
+    user_id = update.effective_user.id if update.effective_user else None
+    await update.message.reply_text(status_text(user_id, await personal_library(user_id)))
 
 async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
     """Global error handler to log and notify owner."""
+    from telegram.error import NetworkError
     logger.exception("Exception while handling an update", exc_info=context.error)
     # By default, avoid owner notifications in serverless/webhook mode to prevent noisy errors
     if os.getenv('ENABLE_OWNER_NOTIFICATIONS') == '1' and OWNER_ID is not None:
         try:
-            await context.bot.send_message(chat_id=OWNER_ID, text=f"⚠️ Bot error: {context.error}")
+            from outbound import PRIORITY_BACKGROUND
+            await context.bot.send_message(
+                chat_id=OWNER_ID, text=f"⚠️ Bot error: {context.error}",
+                rate_limit_args={'priority': PRIORITY_BACKGROUND},
+            )
         except NetworkError as exc:
             # Ignore teardown errors from serverless runtime
             if "Event loop is closed" in str(exc):
@@ -242,26 +631,68 @@ async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
                 return
             raise
 
+def build_application(token, identity=None, **builder_options):
+    """Create the PTB Application with all handlers registered.
+
+    PTB is imported here rather than at module level. If identity (a cached
+    getMe result for this token) is given, initialize() skips getMe.
+    """
+    from telegram.ext import (
+        Application, ChosenInlineResultHandler, CommandHandler, InlineQueryHandler, MessageHandler, filters,
+    )
+    from telegram_request import InstrumentedRequest, preferred_http_version
+    from outbound import OutboundScheduler
+    from bot_identity import CachedIdentityBot, identity_matches_token
+    from dispatcher import create_update_processor
+
+    bot = CachedIdentityBot(
+        token,
+        # Overridable for a local Bot API server or the benchmark fakes
+        base_url=os.getenv('TELEGRAM_API_BASE_URL', 'https://api.telegram.org/bot'),
+        identity=identity if identity_matches_token(identity, token) else None,
+        # Keep-alive pool (HTTP/2 when h2 is installed) reused by every handler
+        request=InstrumentedRequest(connection_pool_size=256, http_version=preferred_http_version()),
+        get_updates_request=InstrumentedRequest(),
+        # Token buckets per Telegram's limits; inline answers go out first
+        rate_limiter=OutboundScheduler(max_retries=int(os.getenv('OUTBOUND_MAX_RETRIES', '2'))),
+    )
+    builder = Application.builder().bot(bot).concurrent_updates(create_update_processor())
+    for option, value in builder_options.items():
+        builder = getattr(builder, option)(value)
+    application = builder.build()
+
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("clear", clear_video))
+    application.add_handler(CommandHandler("status", status))
+    application.add_handler(CommandHandler("import", import_videos))
+    application.add_handler(CommandHandler("done", finish_import))
+    application.add_handler(MessageHandler(filters.VIDEO | filters.Document.VIDEO, store_video_handler))
+    application.add_handler(InlineQueryHandler(inline_query_handler))
+    application.add_handler(ChosenInlineResultHandler(chosen_inline_result_handler))
+    application.add_error_handler(on_error)
+    return application
+
+async def _post_init(application: Application):
+    """Load persisted state and cache the bot identity fetched by initialize()."""
+    await load_state()
+    remember_bot_identity(application.bot.bot)
+
+async def _post_shutdown(application: Application):
+    """Store open video batches, then flush pending state writes and counters on shutdown."""
+    await ingest_batcher.finish_all()
+    await popularity.flush()
+    await state_store.close()
+
 def main():
     """Start the bot."""
+    configure_logging()
     # Get bot token
     token = os.getenv('BOT_TOKEN')
     if not token:
         logger.error("BOT_TOKEN not found in environment variables")
         return
-    # Load state from disk
-    load_state()
-    
-    # Create application
-    application = Application.builder().token(token).build()
-    
-    # Add handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("clear", clear_video))
-    application.add_handler(CommandHandler("status", status))
-    application.add_handler(MessageHandler(filters.VIDEO, store_video_handler))
-    application.add_handler(InlineQueryHandler(inline_query_handler))
-    application.add_error_handler(on_error)
+    # Create application; state is loaded once the event loop is running
+    application = build_application(token, post_init=_post_init, post_shutdown=_post_shutdown)
     
     # Start the bot
     logger.info("Starting bot...")
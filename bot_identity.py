@@ -0,0 +1,48 @@
+"""
+Bot that can start from a cached identity instead of calling getMe
+"""
+
+import asyncio
+
+from telegram import User
+from telegram.ext import ExtBot
+
+
+def identity_from_user(user) -> dict:
+    """The parts of the bot's User worth caching in the state store."""
+    return {
+        'id': user.id,
+        'is_bot': True,
+        'first_name': user.first_name,
+        'username': user.username,
+    }
+
+
+def identity_matches_token(identity, token: str) -> bool:
+    """True if a cached identity belongs to the bot of this token (<bot id>:<secret>)."""
+    if not isinstance(identity, dict) or not identity.get('username'):
+        return False
+    return str(identity.get('id')) == token.split(':', 1)[0]
+
+
+class CachedIdentityBot(ExtBot):
+    """ExtBot whose initialize() skips the getMe round-trip when the identity is known.
+
+    Explicit get_me() calls (e.g. the warm-up cron) still go to Telegram.
+    """
+
+    __slots__ = ('_cached_identity',)
+
+    def __init__(self, *args, identity=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cached_identity = identity
+
+    async def initialize(self):
+        if self._initialized or self._cached_identity is None:
+            await super().initialize()
+            return
+        if self.rate_limiter:
+            await self.rate_limiter.initialize()
+        await asyncio.gather(self._request[0].initialize(), self._request[1].initialize())
+        self._bot_user = User.de_json(self._cached_identity, self)
+        self._initialized = True
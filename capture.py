@@ -0,0 +1,175 @@
+"""
+Opt-in capture of raw webhook traffic for replay (see bench/replay.py)
+
+Each captured request is one JSON line, {"ts": arrival time, "path": request
+path, "body": raw body}, appended to a gzip file by a background thread.
+The file is flushed after every batch, so it can be read while it is still
+being written; when it grows past max_bytes (compressed), and when a new
+process starts capturing, it is rotated like logging's RotatingFileHandler:
+path -> path.1 -> path.2 ...
+"""
+
+import os
+import gzip
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookCapture:
+    """Samples webhook bodies into rotated gzip JSONL files.
+
+    record() never blocks the event loop: it only enqueues. If the writer
+    falls behind and the queue is full, records are dropped and counted.
+    A file that cannot be opened (e.g. a read-only FS) disables capture.
+    """
+
+    def __init__(self, path: str, sample_rate: float = 1.0, max_bytes: int = 64 * 1024 * 1024,
+                 backups: int = 5, queue_size: int = 10000):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.captured = 0
+        self.dropped = 0
+        self.enabled = True
+        self._queue = queue.Queue(queue_size)
+        self._raw = None
+        self._gzip = None
+        self._thread = None
+
+    def record(self, path: str, body: bytes):
+        """Capture one request body (subject to sampling)."""
+        if not self.enabled or (self.sample_rate < 1.0 and random.random() >= self.sample_rate):
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='webhook-capture', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+        try:
+            self._queue.put_nowait((time.time(), path, body))
+        except queue.Full:
+            self.dropped += 1
+
+    def _open(self):
+        # A file left by another process may lack its trailer; never append to it
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            self._rotate()
+        self._raw = open(self.path, 'ab')
+        self._gzip = gzip.GzipFile(fileobj=self._raw, mode='ab')
+
+    def _close_file(self):
+        if self._gzip is not None:
+            self._gzip.close()
+            self._raw.close()
+            self._gzip = self._raw = None
+
+    def _rotate(self):
+        self._close_file()
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def _write(self, item):
+        ts, path, body = item
+        line = json.dumps({'ts': ts, 'path': path, 'body': body.decode('utf-8', 'replace')}, ensure_ascii=False)
+        self._gzip.write(line.encode('utf-8') + b'\n')
+        self.captured += 1
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if self._gzip is None:
+                    self._open()
+                while item is not None:
+                    self._write(item)
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                # One sync flush per batch keeps the file readable without a trailer
+                self._gzip.flush()
+                if self.max_bytes > 0 and self._raw.tell() >= self.max_bytes:
+                    self._rotate()
+            except OSError as exc:
+                logger.warning("Webhook capture disabled: %s", exc)
+                self.enabled = False
+                self._close_file()
+                return
+            if item is None:
+                self._close_file()
+                return
+
+    def close(self):
+        """Write out queued records and finish the current file."""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+
+    def stats(self) -> dict:
+        return {
+            'path': self.path,
+            'enabled': self.enabled,
+            'sample_rate': self.sample_rate,
+            'captured': self.captured,
+            'dropped': self.dropped,
+        }
+
+
+def read_capture(paths):
+    """Yield captured records from the given files in order.
+
+    A file whose writer has not finished (no gzip trailer yet) is read up to
+    its last flushed record; files rotated away meanwhile are skipped.
+    """
+    for path in paths:
+        try:
+            f = gzip.open(path, 'rt', encoding='utf-8')
+        except FileNotFoundError:
+            # Rotated away since the file list was taken
+            continue
+        with f:
+            try:
+                for line in f:
+                    if line.endswith('\n'):
+                        yield json.loads(line)
+            except EOFError:
+                pass
+
+
+def capture_files(path: str) -> list:
+    """path and its rotated backups, oldest first."""
+    backups = []
+    index = 1
+    while os.path.exists(f"{path}.{index}"):
+        backups.append(f"{path}.{index}")
+        index += 1
+    files = backups[::-1]
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def from_env():
+    """WebhookCapture configured from WEBHOOK_CAPTURE_* variables, or None if not enabled."""
+    path = os.getenv('WEBHOOK_CAPTURE_FILE')
+    if not path:
+        return None
+    return WebhookCapture(
+        path,
+        sample_rate=float(os.getenv('WEBHOOK_CAPTURE_SAMPLE', '1')),
+        max_bytes=int(float(os.getenv('WEBHOOK_CAPTURE_MAX_MB', '64')) * 1024 * 1024),
+        backups=int(os.getenv('WEBHOOK_CAPTURE_BACKUPS', '5')),
+    )
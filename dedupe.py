@@ -0,0 +1,74 @@
+"""
+Webhook redelivery suppression by update_id
+"""
+
+import logging
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DUPLICATES = metrics.Counter(
+    'bot_duplicate_updates_total', 'Redelivered updates acknowledged without processing', ('scope',))
+
+
+class UpdateDeduplicator:
+    """Remembers the last `window` update_ids seen by this instance.
+
+    Memory is fixed: a ring buffer of ids plus a set for O(1) membership.
+    With a store and a positive ttl, ids that are new locally are also
+    claimed in the store (SET NX EX on Redis), so a redelivery that lands on
+    another instance is suppressed too. Store failures fail open: the update
+    is processed rather than dropped.
+    """
+
+    def __init__(self, window: int = 4096, store=None, ttl: int = 0):
+        self._ring = [None] * max(1, window)
+        self._next = 0
+        self._seen = set()
+        self.store = store
+        self.ttl = ttl
+        self.suppressed = {'local': 0, 'shared': 0}
+
+    def _remember(self, update_id) -> bool:
+        """Record update_id; True if it was not in the window yet."""
+        if update_id in self._seen:
+            return False
+        evicted = self._ring[self._next]
+        if evicted is not None:
+            self._seen.discard(evicted)
+        self._ring[self._next] = update_id
+        self._next = (self._next + 1) % len(self._ring)
+        self._seen.add(update_id)
+        return True
+
+    def _suppress(self, scope, update_id):
+        self.suppressed[scope] += 1
+        DUPLICATES.inc(scope)
+        logger.info("Suppressed redelivered update %s (%s)", update_id, scope)
+
+    async def is_duplicate(self, update_id) -> bool:
+        """True if this update was already received; marks it as received otherwise."""
+        if update_id is None:
+            return False
+        if not self._remember(update_id):
+            self._suppress('local', update_id)
+            return True
+        if self.store is None or self.ttl <= 0:
+            return False
+        try:
+            claimed = await self.store.claim(f"update:{update_id}", self.ttl)
+        except Exception as exc:
+            logger.warning("Shared dedupe check failed for update %s: %s", update_id, exc)
+            return False
+        if not claimed:
+            self._suppress('shared', update_id)
+            return True
+        return False
+
+    def stats(self) -> dict:
+        return {
+            'window': len(self._ring),
+            'shared_ttl': self.ttl if self.store is not None else 0,
+            'suppressed': dict(self.suppressed),
+        }
@@ -0,0 +1,108 @@
+"""
+Concurrent update processing with per-chat ordering
+"""
+
+import os
+import asyncio
+
+from telegram.ext import BaseUpdateProcessor
+
+from logging_setup import set_correlation_id
+
+
+def update_key(update):
+    """Ordering key for an update: its chat, else its user, else None (unordered)."""
+    chat = getattr(update, 'effective_chat', None)
+    if chat is not None:
+        return ('chat', chat.id)
+    user = getattr(update, 'effective_user', None)
+    if user is not None:
+        return ('user', user.id)
+    return None
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently on a bounded number of workers.
+
+    Updates sharing a key (same chat, or same user for chat-less updates like
+    inline queries) run strictly in arrival order; unrelated updates run in
+    parallel. PTB's own semaphore bounds how many updates may be admitted
+    (running plus waiting), so a burst from one chat cannot occupy worker
+    slots while it waits for its own earlier updates.
+    """
+
+    def __init__(self, max_workers: int = 8, max_pending: int = 256):
+        super().__init__(max_workers + max_pending)
+        self.max_workers = max_workers
+        self._workers = asyncio.Semaphore(max_workers)
+        # key -> future resolved when the latest admitted update for key is done
+        self._tails = {}
+        self._admitted = 0
+        self.in_flight = 0
+        self.processed = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """Updates admitted but still waiting for their turn or a free worker."""
+        return self._admitted - self.in_flight
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.max_workers,
+            'in_flight': self.in_flight,
+            'queue_depth': self.queue_depth,
+            'processed': self.processed,
+        }
+
+    async def do_process_update(self, update, coroutine):
+        # PTB runs each update in its own task, so this only tags this update's logs
+        set_correlation_id(getattr(update, 'update_id', '-'))
+        key = update_key(update)
+        previous = self._tails.get(key) if key is not None else None
+        done = asyncio.get_running_loop().create_future()
+        if key is not None:
+            self._tails[key] = done
+        self._admitted += 1
+        started = False
+        try:
+            if previous is not None:
+                # Shielded: being cancelled here must not cancel the earlier update's future
+                await asyncio.shield(previous)
+            async with self._workers:
+                self.in_flight += 1
+                started = True
+                try:
+                    await coroutine
+                finally:
+                    self.in_flight -= 1
+                    self.processed += 1
+        finally:
+            if not started:
+                # Cancelled while waiting: avoid "coroutine was never awaited"
+                coroutine.close()
+            self._admitted -= 1
+            if previous is not None and not previous.done():
+                # Cancelled while waiting: keep this update's place in line until
+                # the earlier one is done, so later updates still wait for it
+                previous.add_done_callback(lambda _: self._release(key, done))
+            else:
+                self._release(key, done)
+
+    def _release(self, key, done):
+        done.set_result(None)
+        if key is not None and self._tails.get(key) is done:
+            del self._tails[key]
+
+    async def initialize(self):
+        """Nothing to allocate."""
+
+    async def shutdown(self):
+        """Nothing to release."""
+
+
+def create_update_processor() -> KeyedUpdateProcessor:
+    """Build the update processor from UPDATE_WORKERS / UPDATE_QUEUE_LIMIT."""
+    return KeyedUpdateProcessor(
+        max_workers=int(os.getenv('UPDATE_WORKERS', '8')),
+        max_pending=int(os.getenv('UPDATE_QUEUE_LIMIT', '256')),
+    )
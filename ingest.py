@@ -0,0 +1,232 @@
+"""
+Video ingestion: metadata extraction and batching of albums, forwards and imports
+"""
+
+import time
+import asyncio
+import logging
+
+import metrics
+from library import VideoEntry, parse_caption
+
+logger = logging.getLogger(__name__)
+
+INGESTED = metrics.Counter(
+    'bot_ingested_videos_total', 'Received videos by outcome', ('outcome',))
+
+
+def entry_from_message(message):
+    """VideoEntry for a message's video (or video sent as a file), or None.
+
+    All metadata is taken from the message here, once; the title is '' when
+    neither a caption nor a file name gives one, and is numbered on storage.
+    """
+    media = message.video
+    kind = 'video'
+    if media is None:
+        media = message.document
+        kind = 'document'
+        if media is None or not (media.mime_type or '').startswith('video/'):
+            return None
+    title, tags, caption = parse_caption(message.caption, media.file_name)
+    if not caption and not media.file_name:
+        title = ''
+    # PTB < 20.2 calls it thumb
+    thumbnail = getattr(media, 'thumbnail', None) or getattr(media, 'thumb', None)
+    return VideoEntry(
+        media.file_unique_id, media.file_id, title, tags, caption,
+        kind=kind,
+        duration=getattr(media, 'duration', None),
+        width=getattr(media, 'width', None),
+        height=getattr(media, 'height', None),
+        mime_type=media.mime_type,
+        thumbnail_file_id=thumbnail.file_id if thumbnail else None,
+    )
+
+
+def dedupe(target, entries):
+    """Split entries into (new, duplicates) by file_unique_id (the entry id).
+
+    A video counts as a duplicate if target already holds it or it came
+    earlier in entries. Untitled new videos are numbered after target's.
+    """
+    added = []
+    duplicates = []
+    seen = set()
+    for entry in entries:
+        if entry.id in seen or entry.id in target:
+            duplicates.append(entry)
+            continue
+        seen.add(entry.id)
+        if not entry.title:
+            entry.title = f"Video {len(target) + len(added) + 1}"
+        added.append(entry)
+    return added, duplicates
+
+
+def is_batched(message) -> bool:
+    """True for messages that usually arrive in a burst: album items and forwards."""
+    return bool(
+        message.media_group_id
+        or getattr(message, 'forward_origin', None)
+        or getattr(message, 'forward_date', None)
+    )
+
+
+class PendingBatch:
+    """Videos received from one user and not stored yet."""
+
+    __slots__ = ('user_id', 'chat_id', 'bot', 'entries', 'is_import', 'updated', 'stored', 'skipped')
+
+    def __init__(self, user_id, chat_id, bot, is_import=False):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.bot = bot
+        self.entries = []
+        self.is_import = is_import
+        self.updated = time.monotonic()
+        # Videos of an import already stored (immediate mode) and duplicates skipped
+        self.stored = 0
+        self.skipped = 0
+
+
+class IngestBatcher:
+    """Groups a user's incoming videos so each group is stored with one write.
+
+    Album items and forwarded videos join the user's open batch, which is
+    stored once no video arrived for window seconds (or at max_items). An
+    /import session keeps its batch open until finish() (/done) or until it
+    has been idle for import_timeout seconds. Other videos are stored right
+    away, as a batch of one, unless a batch is open.
+
+    store(batch, reply) does the deduplication, storage and (if reply) the
+    reply, and returns (added, duplicates). Like the popularity counters,
+    due batches are stored by a background task and by flush_due_batches().
+
+    With immediate set (webhook mode), nothing waits in memory: a
+    serverless instance may be frozen or recycled right after responding,
+    and album items may reach different instances. Every video is stored
+    by the request that brought it, each with its own reply. During an
+    /import only the counts are kept, for the summary at /done.
+    """
+
+    def __init__(self, store, window: float = 1.5, max_items: int = 200, import_timeout: float = 600.0,
+                 immediate: bool = False):
+        self.store = store
+        self.window = window
+        self.max_items = max_items
+        self.import_timeout = import_timeout
+        self.immediate = immediate
+        # user id -> PendingBatch
+        self._batches = {}
+        self._tasks = {}
+
+    def __len__(self) -> int:
+        return len(self._batches)
+
+    def in_import(self, user_id) -> bool:
+        batch = self._batches.get(user_id)
+        return batch is not None and batch.is_import
+
+    def start_import(self, user_id, chat_id, bot) -> PendingBatch:
+        """Open an import session (keeping videos already waiting in a batch)."""
+        batch = self._batches.get(user_id)
+        if batch is None:
+            batch = self._batches[user_id] = PendingBatch(user_id, chat_id, bot, is_import=True)
+        batch.is_import = True
+        batch.updated = time.monotonic()
+        self._schedule(user_id)
+        return batch
+
+    async def add(self, user_id, chat_id, bot, entry, batched: bool):
+        """Accept one video; stores it now unless it belongs to a batch."""
+        INGESTED.inc('received')
+        batch = self._batches.get(user_id)
+        if self.immediate:
+            single = PendingBatch(user_id, chat_id, bot)
+            single.entries.append(entry)
+            importing = batch is not None and batch.is_import
+            added, duplicates = await self.store(single, not importing)
+            if importing:
+                batch.stored += len(added)
+                batch.skipped += len(duplicates)
+                batch.updated = time.monotonic()
+            return
+        if batch is None:
+            batch = PendingBatch(user_id, chat_id, bot)
+            if not batched:
+                batch.entries.append(entry)
+                await self._store(batch)
+                return
+            self._batches[user_id] = batch
+        batch.entries.append(entry)
+        batch.updated = time.monotonic()
+        if len(batch.entries) >= self.max_items:
+            await self.finish(user_id)
+            return
+        self._schedule(user_id)
+
+    async def finish(self, user_id):
+        """Store the user's open batch now; returns it, or None if there was none."""
+        batch = self._batches.pop(user_id, None)
+        if batch is None:
+            return None
+        task = self._tasks.pop(user_id, None)
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+        await self._store(batch)
+        return batch
+
+    async def finish_all(self):
+        """Store every open batch (on shutdown)."""
+        for user_id in list(self._batches):
+            await self.finish(user_id)
+
+    def _due_in(self, batch) -> float:
+        idle = self.import_timeout if batch.is_import else self.window
+        return batch.updated + idle - time.monotonic()
+
+    @property
+    def flush_due(self) -> bool:
+        return any(self._due_in(batch) <= 0 for batch in self._batches.values())
+
+    async def flush_due_batches(self):
+        """Store every batch whose idle time has passed."""
+        for user_id in [u for u, batch in self._batches.items() if self._due_in(batch) <= 0]:
+            await self.finish(user_id)
+
+    def _schedule(self, user_id):
+        task = self._tasks.get(user_id)
+        if task is not None and not task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._tasks[user_id] = loop.create_task(self._finish_when_idle(user_id))
+
+    async def _finish_when_idle(self, user_id):
+        while True:
+            batch = self._batches.get(user_id)
+            if batch is None:
+                return
+            delay = self._due_in(batch)
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        self._tasks.pop(user_id, None)
+        try:
+            await self.finish(user_id)
+        except Exception as exc:
+            logger.error("Failed to store batch of user %s: %s", user_id, exc)
+
+    async def _store(self, batch):
+        if batch.entries:
+            await self.store(batch, True)
+
+    def stats(self) -> dict:
+        return {
+            'open_batches': len(self._batches),
+            'imports': sum(1 for batch in self._batches.values() if batch.is_import),
+            'pending_videos': sum(len(batch.entries) for batch in self._batches.values()),
+        }
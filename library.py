@@ -0,0 +1,364 @@
+"""
+Video library with an incremental inverted/prefix index for inline search
+"""
+
+import re
+import time
+import heapq
+from bisect import bisect_left, insort
+from itertools import count, islice
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+_HASHTAG_RE = re.compile(r'#(\w+)', re.UNICODE)
+
+# Per-field weights used when ranking matches
+TITLE_WEIGHT = 3
+TAG_WEIGHT = 2
+CAPTION_WEIGHT = 1
+
+MAX_TITLE_LENGTH = 64
+
+# Library versions are unique across all libraries of the process, so a
+# version identifies one library's contents even after it is reloaded
+_versions = count(1)
+
+
+def tokenize(text) -> list:
+    """Lowercase word tokens of text (unicode aware)."""
+    if not text:
+        return []
+    return _TOKEN_RE.findall(text.lower())
+
+
+def parse_caption(caption, fallback_title):
+    """Split an upload caption into (title, tags, caption).
+
+    Hashtags become tags, the first non-empty line without hashtags becomes
+    the title, and the full caption is kept for search.
+    """
+    caption = (caption or '').strip()
+    tags = []
+    for tag in _HASHTAG_RE.findall(caption):
+        tag = tag.lower()
+        if tag not in tags:
+            tags.append(tag)
+    title = ''
+    for line in caption.splitlines():
+        line = _HASHTAG_RE.sub('', line).strip()
+        if line:
+            title = line
+            break
+    title = (title or fallback_title or 'Video')[:MAX_TITLE_LENGTH]
+    return title, tags, caption
+
+
+# File metadata captured at ingest; stored only when known
+METADATA_FIELDS = ('kind', 'duration', 'width', 'height', 'mime_type', 'thumbnail_file_id')
+
+
+class VideoEntry:
+    """A stored video plus the metadata used for search and inline results.
+
+    id is the file_unique_id, which is the same for every copy of a file.
+    kind is 'video', or 'document' for a video sent as a file (it must be
+    answered as a document). duration is in seconds.
+    """
+
+    __slots__ = ('id', 'file_id', 'title', 'tags', 'caption', 'added_at') + METADATA_FIELDS
+
+    def __init__(self, id, file_id, title, tags=(), caption='', added_at=None, kind='video',
+                 duration=None, width=None, height=None, mime_type=None, thumbnail_file_id=None):
+        self.id = id
+        self.file_id = file_id
+        self.title = title
+        self.tags = list(tags)
+        self.caption = caption or ''
+        self.added_at = added_at if added_at is not None else time.time()
+        self.kind = kind or 'video'
+        self.duration = duration
+        self.width = width
+        self.height = height
+        self.mime_type = mime_type
+        self.thumbnail_file_id = thumbnail_file_id
+
+    def to_dict(self) -> dict:
+        data = {
+            'file_id': self.file_id,
+            'title': self.title,
+            'tags': self.tags,
+            'caption': self.caption,
+            'added_at': self.added_at,
+        }
+        for field in METADATA_FIELDS:
+            value = getattr(self, field)
+            if value and not (field == 'kind' and value == 'video'):
+                data[field] = value
+        return data
+
+    @classmethod
+    def from_dict(cls, entry_id, data: dict) -> 'VideoEntry':
+        return cls(
+            entry_id,
+            data['file_id'],
+            data.get('title') or 'Video',
+            data.get('tags') or (),
+            data.get('caption') or '',
+            data.get('added_at') or 0.0,
+            **{field: data.get(field) for field in METADATA_FIELDS},
+        )
+
+    def details(self) -> str:
+        """Duration and dimensions for display, e.g. '1:05 · 1280×720' ('' if unknown)."""
+        parts = []
+        if self.duration:
+            minutes, seconds = divmod(int(self.duration), 60)
+            parts.append(f"{minutes}:{seconds:02d}")
+        if self.width and self.height:
+            parts.append(f"{self.width}×{self.height}")
+        return ' · '.join(parts)
+
+    def weighted_tokens(self) -> dict:
+        """Map each searchable token to its best field weight."""
+        weights = {}
+        for token in tokenize(self.caption):
+            weights[token] = CAPTION_WEIGHT
+        for tag in self.tags:
+            for token in tokenize(tag):
+                weights[token] = max(weights.get(token, 0), TAG_WEIGHT)
+        for token in tokenize(self.title):
+            weights[token] = TITLE_WEIGHT
+        return weights
+
+
+class VideoLibrary:
+    """In-memory collection of videos with an incrementally maintained index.
+
+    The index is an inverted map token -> {weight: set of entry ids} plus a
+    sorted token list, so a query token matches every indexed token it is a
+    prefix of via two bisects. Adding or removing an entry only touches that
+    entry's tokens.
+
+    Field weights take only a few values, so a query's matches fall into a
+    handful of score levels. Search works on whole levels with set
+    operations and only ranks entries within the levels it needs, which
+    keeps short prefixes matching most of the library cheap.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._postings = {}
+        self._tokens = []
+        # entry id -> insertion sequence number (recency for ranking)
+        self._order = {}
+        self._sequence = count()
+        # Takes a new value on every change; lets callers cache derived data
+        self.version = next(_versions)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, entry_id) -> bool:
+        return entry_id in self._entries
+
+    def get(self, entry_id):
+        return self._entries.get(entry_id)
+
+    def recent(self):
+        """Iterate entries newest first (insertion order, reversed)."""
+        return reversed(self._entries.values())
+
+    def add(self, entry: VideoEntry):
+        """Add or replace an entry and index its tokens."""
+        previous = self._entries.pop(entry.id, None)
+        if previous is not None:
+            self._unindex(previous)
+        self._entries[entry.id] = entry
+        self._order[entry.id] = next(self._sequence)
+        for token, weight in entry.weighted_tokens().items():
+            posting = self._postings.get(token)
+            if posting is None:
+                posting = self._postings[token] = {}
+                insort(self._tokens, token)
+            ids = posting.get(weight)
+            if ids is None:
+                ids = posting[weight] = set()
+            ids.add(entry.id)
+        self.version = next(_versions)
+
+    def remove(self, entry_id):
+        """Remove an entry; returns it, or None if it was not stored."""
+        entry = self._entries.pop(entry_id, None)
+        if entry is not None:
+            self._unindex(entry)
+            del self._order[entry_id]
+            self.version = next(_versions)
+        return entry
+
+    def clear(self):
+        self._entries.clear()
+        self._postings.clear()
+        self._tokens.clear()
+        self._order.clear()
+        self.version = next(_versions)
+
+    def _unindex(self, entry: VideoEntry):
+        for token, weight in entry.weighted_tokens().items():
+            posting = self._postings.get(token)
+            if posting is None:
+                continue
+            ids = posting.get(weight)
+            if ids is not None:
+                ids.discard(entry.id)
+                if not ids:
+                    del posting[weight]
+            if not posting:
+                del self._postings[token]
+                index = bisect_left(self._tokens, token)
+                if index < len(self._tokens) and self._tokens[index] == token:
+                    del self._tokens[index]
+
+    def _match_token(self, query_token) -> dict:
+        """Score -> ids of the entries whose best match for query_token scores that."""
+        exact = self._postings.get(query_token)
+        levels = {}
+        if exact is not None:
+            # Exact token matches rank above prefix matches
+            for weight, ids in exact.items():
+                levels[weight + 0.5] = [ids]
+        start = bisect_left(self._tokens, query_token)
+        end = bisect_left(self._tokens, query_token + '\uffff', start)
+        for token in self._tokens[start:end]:
+            posting = self._postings[token]
+            if posting is not exact:
+                for weight, ids in posting.items():
+                    levels.setdefault(weight, []).append(ids)
+        best = {}
+        seen = set()
+        for score in sorted(levels, reverse=True):
+            ids = set().union(*levels[score])
+            ids -= seen
+            if ids:
+                best[score] = ids
+                seen |= ids
+        return best
+
+    def _scores(self, tokens) -> dict:
+        """Score -> ids of the entries matching every query token, scores summed."""
+        levels = None
+        # Intersect starting from the most selective token
+        per_token = [self._match_token(t) for t in set(tokens)]
+        per_token.sort(key=lambda token_levels: sum(map(len, token_levels.values())))
+        for token_levels in per_token:
+            if levels is None:
+                levels = token_levels
+                continue
+            combined = {}
+            for score, ids in levels.items():
+                for token_score, token_ids in token_levels.items():
+                    common = ids & token_ids
+                    if common:
+                        total = score + token_score
+                        if total in combined:
+                            combined[total] |= common
+                        else:
+                            combined[total] = common
+            levels = combined
+            if not levels:
+                return {}
+        return levels or {}
+
+    def _rank_ties(self, ids, limit, popularity) -> list:
+        """Up to limit entries of ids (a set or dict of entry ids) in tie-break order.
+
+        Chosen entries come first, by popularity and then added_at; the
+        never chosen ones follow newest first.
+        """
+        entries = self._entries
+        top = []
+        if popularity:
+            # Walk the smaller side: a personal library is tiny next to the global counts
+            if len(ids) < len(popularity):
+                popular = [i for i in ids if i in popularity]
+            else:
+                popular = [i for i in popularity if i in ids]
+            order = self._order
+            # Insertion order settles ties, so every page of a query agrees
+            key = lambda i: (popularity[i], entries[i].added_at, order[i])
+            if limit is None or len(popular) <= limit:
+                top = sorted(popular, key=key, reverse=True)
+            else:
+                # Select by count alone (no per-item tuples), then break ties at
+                # the cut-off by recency among just the candidates
+                top = heapq.nlargest(limit, popular, key=popularity.__getitem__)
+                floor = popularity[top[-1]]
+                candidates = [i for i in top if popularity[i] > floor]
+                candidates.extend(i for i in popular if popularity[i] == floor)
+                top = heapq.nlargest(limit, candidates, key=key)
+        ranked = [entries[i] for i in top]
+        wanted = None if limit is None else limit - len(ranked)
+        if wanted == 0:
+            return ranked
+        # Every chosen entry of ids is in top already
+        chosen = set(top)
+        remaining = len(ids) - len(chosen)
+        if wanted is not None and 4 * wanted * len(entries) <= remaining * remaining:
+            # Dense: a match turns up every len(entries) / remaining entries, so
+            # walking from the newest beats sorting all of them
+            rest = (entry for entry in self.recent() if entry.id in ids and entry.id not in chosen)
+            ranked.extend(islice(rest, wanted))
+        else:
+            order = self._order
+            rest = sorted((i for i in ids if i not in chosen), key=order.__getitem__, reverse=True)
+            ranked.extend(entries[i] for i in rest[:wanted])
+        return ranked
+
+    def search(self, query, limit=None, popularity=None) -> list:
+        """Ranked entries matching every token of query (newest first if empty).
+
+        popularity (entry id -> times chosen) breaks ties between equally
+        relevant matches, and orders the results of an empty query.
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            if popularity:
+                return self._rank_ties(self._entries, limit, popularity)
+            return list(islice(self.recent(), limit))
+        ranked = []
+        levels = self._scores(tokens)
+        for score in sorted(levels, reverse=True):
+            wanted = None if limit is None else limit - len(ranked)
+            if wanted == 0:
+                break
+            ranked.extend(self._rank_ties(levels[score], wanted, popularity))
+        return ranked
+
+    def search_page(self, query, offset, limit, popularity=None):
+        """One page of search results plus the next_offset for Telegram."""
+        return search_page([self], query, offset, limit, popularity)
+
+
+def search_page(libraries, query, offset, limit, popularity=None):
+    """One page of results across libraries plus the next_offset for Telegram.
+
+    Results of earlier libraries come first; an entry id already listed is
+    skipped in later ones. offset is the InlineQuery.offset string;
+    next_offset is '' when there are no more results.
+    """
+    try:
+        start = max(int(offset), 0) if offset else 0
+    except ValueError:
+        start = 0
+    # Fetch one extra result to learn whether another page exists
+    wanted = start + limit + 1
+    matches = []
+    seen = set()
+    for library in libraries:
+        for entry in library.search(query, wanted, popularity):
+            if entry.id not in seen:
+                seen.add(entry.id)
+                matches.append(entry)
+        if len(matches) >= wanted:
+            break
+    page = matches[start:start + limit]
+    next_offset = str(start + limit) if len(matches) > start + limit else ''
+    return page, next_offset
@@ -0,0 +1,166 @@
+"""
+Logging: JSON records, per-update correlation ids, sampling, off-loop I/O
+
+configure() routes every record through a QueueHandler; a QueueListener
+thread does the formatting and writing, so handlers never block the event
+loop. Records carry the id of the update being handled (set with
+set_correlation_id()), and records below WARNING can be sampled per logger.
+"""
+
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import contextvars
+import logging.handlers
+
+# Id of the update being handled by the current task ('-' outside updates)
+correlation_id = contextvars.ContextVar('correlation_id', default='-')
+
+# Attributes every LogRecord has; anything else was passed via extra=
+_STANDARD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_listener = None
+
+
+def set_correlation_id(value):
+    """Tag log records of the current task (and tasks it starts) with value."""
+    correlation_id.set(str(value))
+
+
+class ContextFilter(logging.Filter):
+    """Stamps the correlation id and drops sampled-out records.
+
+    sampling maps logger name prefixes to the fraction of sub-WARNING
+    records to keep. The decision is made per correlation id, so an update
+    is logged completely or not at all.
+    """
+
+    def __init__(self, sampling=None):
+        super().__init__()
+        # Longest prefix first so 'bot.store' wins over 'bot'
+        self.sampling = sorted((sampling or {}).items(), key=lambda item: -len(item[0]))
+
+    def _rate(self, name):
+        for prefix, rate in self.sampling:
+            if name == prefix or name.startswith(prefix + '.'):
+                return rate
+        return 1.0
+
+    def filter(self, record):
+        record.correlation_id = cid = correlation_id.get()
+        if record.levelno >= logging.WARNING or not self.sampling:
+            return True
+        rate = self._rate(record.name)
+        if rate >= 1.0:
+            return True
+        if rate <= 0.0:
+            return False
+        if cid == '-':
+            return random.random() < rate
+        return (hash(cid) % 10000) < rate * 10000
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message, correlation id, extras."""
+
+    def format(self, record):
+        payload = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'update': getattr(record, 'correlation_id', '-'),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and key != 'correlation_id':
+                payload[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            payload['exc'] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves message formatting to the listener thread.
+
+    The stock prepare() formats every message on the calling thread; here
+    the %-arguments travel with the record instead, so callers should pass
+    values that are not mutated afterwards.
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            # Render the traceback now; its frames must not outlive the call
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def parse_sampling(spec: str) -> dict:
+    """Parse 'bot=0.1,httpx=0' into {'bot': 0.1, 'httpx': 0.0}."""
+    sampling = {}
+    for item in (spec or '').split(','):
+        name, _, rate = item.partition('=')
+        if name.strip() and rate.strip():
+            sampling[name.strip()] = float(rate)
+    return sampling
+
+
+def configure(file_path=None):
+    """Install the queue-based logging setup on the root logger (idempotent).
+
+    LOG_LEVEL (default WARNING), LOG_FORMAT (json|text, default json),
+    LOG_SAMPLE ('logger=rate,...') and LOG_FILE (overrides file_path)
+    come from the environment. Without a writable file only stderr is used.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    level = os.getenv('LOG_LEVEL', 'WARNING').upper()
+    if os.getenv('LOG_FORMAT', 'json').lower() == 'text':
+        formatter = logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - [%(correlation_id)s] %(message)s'
+        )
+    else:
+        formatter = JsonFormatter()
+    handlers = [logging.StreamHandler(sys.stderr)]
+    file_path = os.getenv('LOG_FILE', file_path)
+    if file_path:
+        try:
+            handlers.append(logging.FileHandler(file_path))
+        except OSError:
+            # Read-only FS (e.g., Vercel). Skip file logging.
+            pass
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter(parse_sampling(os.getenv('LOG_SAMPLE', ''))))
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    # Suppress noisy third-party loggers
+    logging.getLogger("httpx").setLevel(logging.ERROR)
+    logging.getLogger("telegram").setLevel(logging.WARNING)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """Stop the listener thread after writing out queued records."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
@@ -0,0 +1,191 @@
+"""
+Minimal in-process Prometheus metrics (text exposition format 0.0.4)
+
+Kept dependency-free and cheap: observing a histogram is a bisect plus a few
+list updates, so it can sit on the inline hot path. Metrics are per process;
+on serverless every warm instance reports its own counters.
+"""
+
+import time
+import functools
+from bisect import bisect_left
+
+# Seconds; tuned for a bot whose hot path is sub-millisecond and whose
+# outbound calls take tens to hundreds of milliseconds
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+_registry = []
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs.extend(f'{n}="{_escape(v)}"' for n, v in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter with optional labels."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, _labels(self.labelnames, labels), value
+
+
+class Histogram:
+    """Cumulative histogram with optional labels."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (+Inf last), sum, count]
+        self._values = {}
+        _registry.append(self)
+
+    def observe(self, value, *labels):
+        state = self._values.get(labels)
+        if state is None:
+            state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def time(self, *labels):
+        """Context manager observing the elapsed time of its block."""
+        return _Timer(self, labels)
+
+    def samples(self):
+        for labels, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield (f"{self.name}_bucket",
+                       _labels(self.labelnames, labels, (('le', _number(bound)),)), cumulative)
+            yield f"{self.name}_sum", _labels(self.labelnames, labels), total
+            yield f"{self.name}_count", _labels(self.labelnames, labels), count
+
+
+class CallbackMetric:
+    """Gauge or counter read from a callback at scrape time (no hot-path cost).
+
+    The callback returns a number, a dict mapping label tuples to numbers, or
+    None to skip the metric (e.g. before the PTB application exists).
+    """
+
+    def __init__(self, name, help_text, callback, labelnames=(), kind='gauge'):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+        _registry.append(self)
+
+    def samples(self):
+        value = self.callback()
+        if value is None:
+            return
+        if isinstance(value, dict):
+            for labels, item in value.items():
+                yield self.name, _labels(self.labelnames, labels), item
+        else:
+            yield self.name, '', value
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+        return False
+
+
+def render() -> str:
+    """All registered metrics in Prometheus text format."""
+    lines = []
+    for metric in _registry:
+        try:
+            samples = list(metric.samples())
+        except Exception:
+            # A broken callback must not take the whole scrape down
+            continue
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in samples:
+            lines.append(f"{name}{labels} {_number(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Shared metrics ------------------------------------------------------------
+
+HANDLER_SECONDS = Histogram(
+    'bot_handler_seconds', 'Time spent in update handlers', ('handler',))
+HANDLER_ERRORS = Counter(
+    'bot_handler_errors_total', 'Exceptions raised by update handlers', ('handler',))
+BOT_API_SECONDS = Histogram(
+    'bot_api_request_seconds', 'Outbound Telegram Bot API call latency', ('method', 'status'))
+STATE_STORE_SECONDS = Histogram(
+    'bot_state_store_seconds', 'State store backend round-trip latency', ('backend', 'operation'))
+STATE_STORE_ERRORS = Counter(
+    'bot_state_store_errors_total', 'Failed state store backend operations', ('backend', 'operation'))
+WEBHOOK_SECONDS = Histogram(
+    'bot_webhook_seconds', 'Webhook request handling time', ('path',))
+WARM_SECONDS = Histogram(
+    'bot_warm_seconds', 'Warm-up step latency', ('step',))
+
+
+def instrument_handler(handler):
+    """Decorator recording latency and errors of a PTB handler callback."""
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        start = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, name)
+
+    return wrapper
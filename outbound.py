@@ -0,0 +1,247 @@
+"""
+Outbound Bot API scheduler: token buckets, flood waits and priorities
+"""
+
+import math
+import time
+import heapq
+import asyncio
+import logging
+from itertools import count
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Lower goes first. Pass rate_limit_args={'priority': ...} to override.
+PRIORITY_INLINE = 0
+PRIORITY_REPLY = 1
+PRIORITY_BACKGROUND = 2
+
+_PRIORITY_NAMES = {PRIORITY_INLINE: 'inline', PRIORITY_REPLY: 'reply', PRIORITY_BACKGROUND: 'background'}
+
+QUEUE_WAIT_SECONDS = metrics.Histogram(
+    'bot_outbound_wait_seconds', 'Time outbound Bot API calls waited for the scheduler', ('priority',))
+RETRY_AFTER = metrics.Counter(
+    'bot_outbound_retry_after_total', 'Flood-wait (429 RetryAfter) responses from Telegram', ('method',))
+
+
+class TokenBucket:
+    """rate tokens per second, holding at most capacity."""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until one token is available (0 if it is now)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+def _retry_after_seconds(exc: RetryAfter) -> float:
+    value = exc.retry_after
+    # An int in PTB 20.x, a timedelta in later versions
+    return value.total_seconds() if hasattr(value, 'total_seconds') else float(value)
+
+
+class OutboundScheduler(BaseRateLimiter):
+    """Rate limiter for every call PTB makes, with a priority queue in front.
+
+    Messages (calls with a chat_id) take a token from the global bucket
+    (~30/s) and from their chat's bucket: ~1/s for private chats, 20/minute
+    for groups and channels. Calls without a chat, such as answerInlineQuery
+    or getMe, need no tokens. A 429 RetryAfter on a message pauses that
+    chat for the requested time; on a chat-less call it pauses every call.
+    The call is then retried (up to max_retries), except an inline answer
+    the client would no longer wait for: answerInlineQuery is not retried,
+    or even sent, past inline_timeout seconds after it was first sent.
+
+    Waiting calls are released in priority order: inline answers, which
+    have a hard client deadline, then replies, then background sends like
+    owner notifications. Calls for a chat that is over its limit do not
+    hold up other chats. When nothing is waiting and tokens are available,
+    a call goes out without touching the queue.
+    """
+
+    __slots__ = (
+        'overall_rate', 'private_rate', 'private_burst', 'group_rate', 'group_burst', 'max_retries',
+        'inline_timeout', '_global', '_chats', '_waiting', '_seq', '_paused_until', '_chat_paused',
+        '_timer', '_takes',
+    )
+
+    def __init__(
+        self,
+        overall_rate: float = 30.0,
+        private_rate: float = 1.0,
+        private_burst: float = 3.0,
+        group_rate: float = 20 / 60,
+        group_burst: float = 20.0,
+        max_retries: int = 2,
+        inline_timeout: float = 4.0,
+    ):
+        self.overall_rate = overall_rate
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.inline_timeout = inline_timeout
+        self._global = None
+        self._chats = {}
+        # (priority, seq, chat_id, future)
+        self._waiting = []
+        self._seq = count()
+        # Flood waits: bot-wide (from chat-less calls) and per chat id
+        self._paused_until = 0.0
+        self._chat_paused = {}
+        self._timer = None
+        self._takes = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    @staticmethod
+    def _priority(endpoint, rate_limit_args) -> int:
+        if isinstance(rate_limit_args, dict) and 'priority' in rate_limit_args:
+            return rate_limit_args['priority']
+        if endpoint == 'answerInlineQuery':
+            return PRIORITY_INLINE
+        return PRIORITY_REPLY
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Positive ids are users (private chats); groups, channels and @usernames are not
+            private = isinstance(chat_id, int) and chat_id > 0
+            bucket = self._chats[chat_id] = TokenBucket(
+                self.private_rate if private else self.group_rate,
+                self.private_burst if private else self.group_burst,
+                now,
+            )
+        return bucket
+
+    def _wait_time(self, chat_id, now) -> float:
+        paused = self._paused_until - now
+        if chat_id is None:
+            return max(0.0, paused)
+        paused = max(paused, self._chat_paused.get(chat_id, 0.0) - now)
+        if paused > 0:
+            return paused
+        if self._global is None:
+            self._global = TokenBucket(self.overall_rate, self.overall_rate, now)
+        return max(self._global.wait_time(now), self._chat_bucket(chat_id, now).wait_time(now))
+
+    def _take(self, chat_id, now):
+        if chat_id is None:
+            return
+        self._global.take(now)
+        self._chat_bucket(chat_id, now).take(now)
+        self._takes += 1
+        if self._takes % 1024 == 0:
+            # Forget chats that are idle again so the table stays small
+            self._chats = {c: b for c, b in self._chats.items() if not b.is_full(now)}
+            self._chat_paused = {c: until for c, until in self._chat_paused.items() if until > now}
+
+    def _pump(self):
+        """Release every waiting call that may go now; re-arm for the rest."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        blocked = []
+        next_wake = None
+        while self._waiting:
+            item = heapq.heappop(self._waiting)
+            future = item[3]
+            if future.done():
+                # Caller was cancelled
+                continue
+            wait = self._wait_time(item[2], now)
+            if wait <= 0:
+                self._take(item[2], now)
+                future.set_result(None)
+            else:
+                blocked.append(item)
+                next_wake = wait if next_wake is None else min(next_wake, wait)
+        for item in blocked:
+            heapq.heappush(self._waiting, item)
+        if next_wake is not None:
+            self._timer = asyncio.get_running_loop().call_later(next_wake, self._pump)
+
+    async def _acquire(self, priority, chat_id):
+        now = time.monotonic()
+        if not self._waiting and self._wait_time(chat_id, now) <= 0:
+            self._take(chat_id, now)
+            QUEUE_WAIT_SECONDS.observe(0.0, _PRIORITY_NAMES.get(priority, str(priority)))
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._seq), chat_id, future))
+        self._pump()
+        await future
+        QUEUE_WAIT_SECONDS.observe(time.monotonic() - now, _PRIORITY_NAMES.get(priority, str(priority)))
+
+    def _pause(self, endpoint, chat_id, delay: float) -> float:
+        """Apply a flood wait; returns when it ends."""
+        until = time.monotonic() + delay
+        if chat_id is None:
+            self._paused_until = max(self._paused_until, until)
+            logger.warning("Flood wait on %s: pausing outbound calls for %.1fs", endpoint, delay)
+        else:
+            self._chat_paused[chat_id] = max(self._chat_paused.get(chat_id, 0.0), until)
+            logger.warning("Flood wait on %s: pausing calls to chat %s for %.1fs", endpoint, chat_id, delay)
+        return until
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = self._priority(endpoint, rate_limit_args)
+        chat_id = data.get('chat_id')
+        deadline = time.monotonic() + self.inline_timeout if endpoint == 'answerInlineQuery' else None
+        attempt = 0
+        while True:
+            if deadline is not None:
+                now = time.monotonic()
+                wait = self._wait_time(chat_id, now)
+                if now + wait > deadline:
+                    # The answer would only go out after the client gave up on it
+                    raise RetryAfter(math.ceil(wait))
+            await self._acquire(priority, chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                RETRY_AFTER.inc(endpoint)
+                until = self._pause(endpoint, chat_id, _retry_after_seconds(exc))
+                if attempt >= self.max_retries or (deadline is not None and until > deadline):
+                    raise
+                attempt += 1
+
+    def stats(self) -> dict:
+        return {
+            'waiting': sum(1 for item in self._waiting if not item[3].done()),
+            'paused_for': round(max(0.0, self._paused_until - time.monotonic()), 3),
+            'paused_chats': sum(1 for until in self._chat_paused.values() if until > time.monotonic()),
+            'chats': len(self._chats),
+        }
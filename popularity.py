@@ -0,0 +1,105 @@
+"""
+Counts of chosen inline results, flushed to the state store in batches
+"""
+
+import time
+import asyncio
+import logging
+from collections import Counter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CHOSEN = metrics.Counter(
+    'bot_inline_chosen_total', 'Inline results sent by users', ('chat_type',))
+
+
+class PopularityCounter:
+    """Selections per video (and per video and chat type).
+
+    record() only updates in-process counters. flush() sends everything
+    recorded since the previous flush as one batched increment (a single
+    pipelined request on Redis), at most once per interval seconds.
+
+    The store hash at key holds '<entry id>' -> total and
+    '<entry id>:<chat type>' -> per chat type count. Ranking reads scores, a
+    snapshot of the totals refreshed on flush; version changes with it, so
+    cached inline answers are rebuilt at most once per interval.
+    """
+
+    def __init__(self, store, key: str, interval: float = 5.0):
+        self.store = store
+        self.key = key
+        self.interval = interval
+        # entry id -> total selections, as used for ranking
+        self.scores = {}
+        self.version = 0
+        self._totals = {}
+        self._pending = Counter()
+        self._last_flush = time.monotonic()
+        self._flush_task = None
+
+    def load(self, stored: dict):
+        """Replace totals with the stored hash, keeping not yet flushed selections."""
+        totals = {}
+        for field, value in stored.items():
+            if ':' not in field:
+                totals[field] = int(value or 0)
+        for field, amount in self._pending.items():
+            if ':' not in field:
+                totals[field] = totals.get(field, 0) + amount
+        self._totals = totals
+        self._publish()
+
+    def record(self, entry_id: str, chat_type: str):
+        """Count one selection; persistence happens later in a batch."""
+        chat_type = chat_type or 'unknown'
+        self._totals[entry_id] = self._totals.get(entry_id, 0) + 1
+        self._pending[entry_id] += 1
+        self._pending[f"{entry_id}:{chat_type}"] += 1
+        CHOSEN.inc(chat_type)
+        self._schedule_flush()
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    @property
+    def flush_due(self) -> bool:
+        """True if there are selections to flush and the interval has passed."""
+        return bool(self._pending) and time.monotonic() - self._last_flush >= self.interval
+
+    def _schedule_flush(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._flush_task = loop.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        delay = self.interval - (time.monotonic() - self._last_flush)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self.flush()
+
+    async def flush(self):
+        """Publish the current totals for ranking and persist pending selections."""
+        self._publish()
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, Counter()
+        try:
+            await self.store.increment(self.key, dict(batch))
+        except Exception as exc:
+            logger.error("Failed to flush %d popularity counters: %s", len(batch), exc)
+            # Retried with the next batch
+            self._pending.update(batch)
+
+    def _publish(self):
+        if self._totals != self.scores:
+            self.scores = dict(self._totals)
+            self.version += 1
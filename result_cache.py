@@ -0,0 +1,46 @@
+"""
+LRU cache of prebuilt inline query answers
+"""
+
+from collections import OrderedDict
+
+
+class InlineResultCache:
+    """Bounded LRU of JSON-ready inline answers, invalidated by state changes.
+
+    Entries are keyed by the caller (typically state version, query, offset,
+    chat type and user bucket) and hold (results, next_offset) where results
+    is a list of plain dicts that can be handed to answerInlineQuery as-is.
+    Any change of version drops every entry at once.
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_or_build(self, version, key, build):
+        """Return the cached answer for key, calling build() on a miss."""
+        if version != self.version:
+            self._entries.clear()
+            self.version = version
+        try:
+            answer = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            answer = self._entries[key] = build()
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return answer
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return answer
+
+    def clear(self):
+        self._entries.clear()
+        self.version = None
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Startup profiling: per-phase import and initialization timings
+
+Phases are always recorded (it is just a perf_counter pair per phase); set
+STARTUP_PROFILE=1 to have them logged and returned by GET /api/bot.
+Run this file directly to profile a cold import of the webhook app.
+"""
+
+import os
+import sys
+import time
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv('STARTUP_PROFILE') == '1'
+
+_started = time.perf_counter()
+_phases = []
+
+
+@contextmanager
+def phase(name: str):
+    """Time a startup phase."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        _phases.append((name, round(elapsed_ms, 2)))
+        if ENABLED:
+            logger.warning("Startup phase %r took %.1fms", name, elapsed_ms)
+
+
+def report() -> dict:
+    """Recorded phases, in completion order, plus time since profiling started."""
+    return {
+        'phases': [{'name': name, 'ms': ms} for name, ms in _phases],
+        'since_start_ms': round((time.perf_counter() - _started) * 1000, 2),
+    }
+
+
+def main():
+    """Profile a cold import of api.bot and print the phase timings."""
+    os.environ.setdefault('BOT_TOKEN', '0:profile')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    # Use the importable module, not __main__, so phases recorded by api.bot land here
+    import startup_profile
+    with startup_profile.phase('import api.bot'):
+        import api.bot  # noqa: F401
+    for item in startup_profile.report()['phases']:
+        print(f"{item['ms']:10.1f} ms  {item['name']}")
+
+
+if __name__ == '__main__':
+    main()
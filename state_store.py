@@ -0,0 +1,861 @@
+"""
+Async state store with write-behind persistence
+"""
+
+import gc
+import os
+import json
+import errno
+import mmap
+import time
+import zlib
+import struct
+import asyncio
+import logging
+import tempfile
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Marker for keys deleted locally but not yet flushed to the backend
+_DELETED = object()
+
+# Monotonic counter bumped on every flush, so instances can cheaply detect
+# that another instance changed the state
+VERSION_KEY = 'state_version'
+
+# Idle time before a pooled Redis REST connection is closed
+REDIS_KEEPALIVE_SECONDS = 120.0
+
+
+class StateStore:
+    """Key/value state kept in memory and flushed to a backend in the background.
+
+    Reads are served from memory once a key has been seen. Writes update memory
+    immediately and are coalesced into a single backend write shortly after, so
+    handlers never wait on persistence.
+
+    Every flush bumps a version counter in the backend. refresh_version()
+    compares it with the last version this instance saw, which tells callers
+    whether to invalidate() and re-read without fetching the state itself.
+    Keys passed to exclude_from_version() are left out of this: their owners
+    track changes at a finer grain, so writing them does not make every
+    instance reload everything.
+    """
+
+    # Label for the state store metrics
+    backend_name = 'base'
+
+    # Backoff between retries of a failed flush (doubling up to the max)
+    FLUSH_RETRY_MIN = 0.5
+    FLUSH_RETRY_MAX = 30.0
+
+    def __init__(self, flush_delay: float = 0.05):
+        self.flush_delay = flush_delay
+        self._cache = {}
+        self._pending = {}
+        self._pending_hash = {}
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+        # Consecutive failed flushes, for the retry backoff
+        self._failures = 0
+        self._closed = False
+        # Last backend version seen by this instance (None until first checked)
+        self.version = None
+        self._stale = False
+        self._unversioned = set()
+        # key -> monotonic expiry, for the default in-process claim()
+        self._claims = {}
+
+    # Backend hooks -------------------------------------------------------
+
+    async def _read(self, key):
+        """Fetch a single key from the backend. Returns None if missing."""
+        raise NotImplementedError
+
+    async def _read_hash(self, key) -> dict:
+        """Fetch all fields of a hash from the backend."""
+        raise NotImplementedError
+
+    async def _read_field(self, key, field):
+        """Fetch one field of a hash from the backend. Returns None if missing."""
+        raise NotImplementedError
+
+    async def _write(self, changes: dict, hash_changes: dict):
+        """Persist a batch of changes. Values equal to _DELETED are deletions.
+
+        Plain key changes (including deleting a whole hash) are applied before
+        hash_changes, which maps hash key -> {field: value or _DELETED}.
+        """
+        raise NotImplementedError
+
+    async def _increment(self, key, increments: dict):
+        """Add {field: amount} to integer hash fields in one backend round-trip."""
+        raise NotImplementedError
+
+    async def _read_version(self) -> int:
+        """Fetch the current version counter from the backend."""
+        raise NotImplementedError
+
+    async def _incr_version(self) -> int:
+        """Bump the version counter in the backend and return the new value."""
+        raise NotImplementedError
+
+    async def _set_nx(self, key, ttl: int) -> bool:
+        """Create key with a TTL unless it exists; True if it was created.
+
+        The default only coordinates within this process; shared backends
+        override it.
+        """
+        now = time.monotonic()
+        expiry = self._claims.get(key)
+        if expiry is not None and expiry > now:
+            return False
+        if len(self._claims) > 10000:
+            self._claims = {k: v for k, v in self._claims.items() if v > now}
+        self._claims[key] = now + ttl
+        return True
+
+    async def ping(self):
+        """Do one cheap backend round-trip (used to keep connections warm)."""
+        await self._timed('ping', self._read_version())
+
+    async def _close_backend(self):
+        """Release backend resources."""
+
+    async def _timed(self, operation: str, awaitable):
+        """Await a backend call, recording its latency and failures."""
+        start = time.perf_counter()
+        try:
+            return await awaitable
+        except Exception:
+            metrics.STATE_STORE_ERRORS.inc(self.backend_name, operation)
+            raise
+        finally:
+            metrics.STATE_STORE_SECONDS.observe(
+                time.perf_counter() - start, self.backend_name, operation
+            )
+
+    # Public API ----------------------------------------------------------
+
+    async def get(self, key, default=None):
+        """Return the value for key, reading through to the backend once."""
+        if key in self._pending:
+            value = self._pending[key]
+            return default if value is _DELETED else value
+        if key not in self._cache:
+            self._cache[key] = await self._timed('read', self._read(key))
+        value = self._cache[key]
+        return default if value is None else value
+
+    def set(self, key, value):
+        """Update key in memory and schedule a background flush."""
+        self._cache[key] = value
+        self._pending[key] = value
+        self._schedule_flush()
+
+    def delete(self, key):
+        """Remove key in memory and schedule a background flush."""
+        self._cache[key] = None
+        self._pending[key] = _DELETED
+        self._pending_hash.pop(key, None)
+        self._schedule_flush()
+
+    async def hgetall(self, key) -> dict:
+        """Return a copy of all fields of the hash stored at key."""
+        cached = self._cache.get(key)
+        if not isinstance(cached, dict):
+            if self._pending.get(key) is _DELETED:
+                cached = {}
+            else:
+                cached = await self._timed('read_hash', self._read_hash(key))
+            for field, value in self._pending_hash.get(key, {}).items():
+                if value is _DELETED:
+                    cached.pop(field, None)
+                else:
+                    cached[field] = value
+            self._cache[key] = cached
+        return dict(cached)
+
+    async def hget(self, key, field):
+        """Return one field of a hash, without loading or caching the whole hash."""
+        field = str(field)
+        pending = self._pending_hash.get(key, {})
+        if field in pending:
+            value = pending[field]
+            return None if value is _DELETED else value
+        if self._pending.get(key) is _DELETED:
+            return None
+        cached = self._cache.get(key)
+        if isinstance(cached, dict):
+            return cached.get(field)
+        return await self._timed('read_field', self._read_field(key, field))
+
+    def hset(self, key, field, value):
+        """Set one field of a hash in memory and schedule a background flush."""
+        field = str(field)
+        cached = self._cache.get(key)
+        if isinstance(cached, dict):
+            cached[field] = value
+        self._pending_hash.setdefault(key, {})[field] = value
+        self._schedule_flush()
+
+    def hdel(self, key, field):
+        """Delete one field of a hash in memory and schedule a background flush."""
+        field = str(field)
+        cached = self._cache.get(key)
+        if isinstance(cached, dict):
+            cached.pop(field, None)
+        self._pending_hash.setdefault(key, {})[field] = _DELETED
+        self._schedule_flush()
+
+    async def increment(self, key, increments: dict):
+        """Add to integer fields of a hash right away, bypassing write-behind.
+
+        Meant for counters, so it does not bump the state version (which would
+        make every other instance reload the whole state).
+        """
+        await self._timed('increment', self._increment(key, increments))
+        cached = self._cache.get(key)
+        if isinstance(cached, dict):
+            _apply_increments(cached, increments)
+
+    async def refresh_version(self) -> bool:
+        """Read the backend version; True if state changed since this instance last looked."""
+        current = int(await self._timed('read_version', self._read_version()) or 0)
+        changed = self._stale or (self.version is not None and current != self.version)
+        self.version = current
+        self._stale = False
+        return changed
+
+    async def claim(self, key, ttl: int) -> bool:
+        """Atomically mark key as taken for ttl seconds; False if already taken.
+
+        Goes straight to the backend (no write-behind), so it can arbitrate
+        between instances.
+        """
+        return await self._timed('claim', self._set_nx(key, ttl))
+
+    def exclude_from_version(self, *keys):
+        """Don't bump the state version for batches that only change these keys."""
+        self._unversioned.update(keys)
+
+    def _bumps_version(self, changes: dict, hash_changes: dict) -> bool:
+        return any(key not in self._unversioned for key in changes) or any(
+            key not in self._unversioned for key in hash_changes)
+
+    def invalidate(self):
+        """Forget cached reads so the next get()/hgetall() hits the backend.
+
+        Pending writes are kept and still overlay whatever is read back.
+        """
+        self._cache.clear()
+
+    @property
+    def dirty(self) -> bool:
+        """True while there are writes that have not reached the backend yet."""
+        return bool(self._pending or self._pending_hash)
+
+    def _schedule_flush(self, delay=None):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No loop (e.g. called from sync code); the next flush() picks it up
+            return
+        task = self._flush_task
+        # The flush task itself may schedule its retry
+        if task is not None and not task.done() and task is not asyncio.current_task():
+            return
+        self._flush_task = loop.create_task(self._delayed_flush(self.flush_delay if delay is None else delay))
+
+    async def _delayed_flush(self, delay: float):
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self.flush()
+
+    def _requeue(self, batch: dict, hash_batch: dict):
+        """Put a batch that did not reach the backend back under newer pending writes."""
+        for key, fields in hash_batch.items():
+            # A later set or delete of the whole key supersedes these fields
+            if key in self._pending:
+                continue
+            merged = self._pending_hash.setdefault(key, {})
+            for field, value in fields.items():
+                merged.setdefault(field, value)
+        # Plain changes are applied before hash changes, so a restored delete
+        # still lands before fields written after it
+        for key, value in batch.items():
+            self._pending.setdefault(key, value)
+
+    async def flush(self):
+        """Write all pending changes to the backend."""
+        async with self._flush_lock:
+            while self._pending or self._pending_hash:
+                batch, self._pending = self._pending, {}
+                hash_batch, self._pending_hash = self._pending_hash, {}
+                try:
+                    await self._timed('write', self._write(batch, hash_batch))
+                    if self._bumps_version(batch, hash_batch):
+                        new_version = int(await self._timed('incr_version', self._incr_version()))
+                        # A gap means another instance wrote in between
+                        if self.version is not None and new_version != self.version + 1:
+                            self._stale = True
+                        self.version = new_version
+                except BaseException as exc:
+                    # Also on cancellation: the batch is no longer in _pending
+                    self._requeue(batch, hash_batch)
+                    if not isinstance(exc, Exception):
+                        raise
+                    self._failures += 1
+                    delay = min(self.FLUSH_RETRY_MAX, self.FLUSH_RETRY_MIN * 2 ** (self._failures - 1))
+                    logger.error("Failed to flush state (%d keys): %s; retrying in %.1fs",
+                                 len(batch) + len(hash_batch), exc, delay)
+                    if not self._closed:
+                        self._schedule_flush(delay)
+                    return
+            self._failures = 0
+
+    async def close(self):
+        """Flush pending writes and release backend resources."""
+        self._closed = True
+        task = self._flush_task
+        if task is not None and not task.done():
+            # A write in progress puts its batch back when cancelled
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        await self._close_backend()
+
+
+def _apply_changes(data: dict, changes: dict, hash_changes: dict):
+    """Apply a write batch in place to a plain dict (used by the in-process backends)."""
+    for key, value in changes.items():
+        if value is _DELETED:
+            data.pop(key, None)
+        else:
+            data[key] = value
+    for key, fields in hash_changes.items():
+        current = data.get(key)
+        if not isinstance(current, dict):
+            current = data[key] = {}
+        for field, value in fields.items():
+            if value is _DELETED:
+                current.pop(field, None)
+            else:
+                current[field] = value
+
+
+def _apply_increments(fields: dict, increments: dict):
+    for field, amount in increments.items():
+        fields[field] = int(fields.get(field) or 0) + amount
+
+
+def _increment_hash(data: dict, key, increments: dict):
+    """Apply counter increments to a hash inside a plain dict."""
+    current = data.get(key)
+    if not isinstance(current, dict):
+        current = data[key] = {}
+    _apply_increments(current, increments)
+
+
+# Log file: magic, generation, then records of (length, CRC-32) + JSON payload
+_LOG_MAGIC = b'VBLOG\x01'
+_SNAPSHOT_MAGIC = b'VBSNAP\x01'
+_GENERATION = struct.Struct('<Q')
+_RECORD = struct.Struct('<II')
+# Snapshot: magic, then generation, payload length and CRC-32, then the JSON state
+_SNAPSHOT = struct.Struct('<QII')
+_LOG_HEADER_SIZE = len(_LOG_MAGIC) + _GENERATION.size
+
+
+def _encode_record(record: dict) -> bytes:
+    body = json.dumps(record, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return _RECORD.pack(len(body), zlib.crc32(body)) + body
+
+
+def _scan_records(buffer, offset: int):
+    """Yield (payload, end offset) per intact record, stopping at the first torn or corrupt one."""
+    size = len(buffer)
+    while offset + _RECORD.size <= size:
+        length, crc = _RECORD.unpack_from(buffer, offset)
+        start = offset + _RECORD.size
+        end = start + length
+        if end > size:
+            return
+        body = buffer[start:end]
+        if zlib.crc32(body) != crc:
+            return
+        yield body, end
+        offset = end
+
+
+def _batch_record(changes: dict, hash_changes: dict) -> dict:
+    """Log record for a write batch; JSON has no _DELETED, so removals are listed apart."""
+    record = {}
+    sets = {k: v for k, v in changes.items() if v is not _DELETED}
+    deletes = [k for k, v in changes.items() if v is _DELETED]
+    hash_sets = {}
+    hash_deletes = {}
+    for key, fields in hash_changes.items():
+        values = {f: v for f, v in fields.items() if v is not _DELETED}
+        removed = [f for f, v in fields.items() if v is _DELETED]
+        if values:
+            hash_sets[key] = values
+        if removed:
+            hash_deletes[key] = removed
+    for name, value in (('s', sets), ('d', deletes), ('h', hash_sets), ('hd', hash_deletes)):
+        if value:
+            record[name] = value
+    return record
+
+
+def _apply_record(data: dict, record: dict):
+    """Replay one log record onto the state dict."""
+    changes = dict(record.get('s', {}))
+    for key in record.get('d', ()):
+        changes[key] = _DELETED
+    hash_changes = {key: dict(fields) for key, fields in record.get('h', {}).items()}
+    for key, fields in record.get('hd', {}).items():
+        for field in fields:
+            hash_changes.setdefault(key, {})[field] = _DELETED
+    _apply_changes(data, changes, hash_changes)
+    for key, increments in record.get('i', {}).items():
+        _increment_hash(data, key, increments)
+    if 'v' in record:
+        data[VERSION_KEY] = record['v']
+
+
+def _file_id(path):
+    """(inode, size) of path, or None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size
+
+
+def _atomic_write(path: str, chunks):
+    """Replace path with chunks (temp file + fsync + rename)."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.state-', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class MemoryStateStore(StateStore):
+    """Process-local store, mostly useful for tests and benchmarks."""
+
+    backend_name = 'memory'
+
+    def __init__(self, flush_delay: float = 0.0):
+        super().__init__(flush_delay)
+        self._data = {}
+
+    async def _read(self, key):
+        return self._data.get(key)
+
+    async def _read_hash(self, key) -> dict:
+        value = self._data.get(key)
+        return dict(value) if isinstance(value, dict) else {}
+
+    async def _read_field(self, key, field):
+        value = self._data.get(key)
+        return value.get(field) if isinstance(value, dict) else None
+
+    async def _write(self, changes: dict, hash_changes: dict):
+        _apply_changes(self._data, changes, hash_changes)
+
+    async def _increment(self, key, increments: dict):
+        _increment_hash(self._data, key, increments)
+
+    async def _read_version(self) -> int:
+        return self._data.get(VERSION_KEY, 0)
+
+    async def _incr_version(self) -> int:
+        self._data[VERSION_KEY] = self._data.get(VERSION_KEY, 0) + 1
+        return self._data[VERSION_KEY]
+
+
+class LogStateStore(StateStore):
+    """Local state as an append-only record log plus periodic snapshots.
+
+    <path>.log holds one record per flushed batch (or counter increment):
+    a length and CRC-32 header followed by the JSON of just the changes, so
+    persisting a write costs O(changes), not O(state). <path>.snapshot
+    holds the whole state. Once the log outgrows the snapshot (and
+    COMPACT_MIN_BYTES), the state is written to a new snapshot and the log
+    starts over. Both files carry a generation number; a log whose
+    generation does not match the snapshot is left over from an
+    interrupted compaction and is ignored, as the snapshot already holds it.
+
+    Both files are read through mmap on startup. A torn or corrupt record
+    at the end of the log (a crash mid-append) ends the replay and is
+    truncated away. A legacy <path>.json is imported on first use and
+    renamed to <path>.json.migrated. If the files cannot be written, the
+    state is still loaded and served, and writes fail.
+
+    Meant for a single writing process; other processes pick up its
+    appends when they check the version.
+    """
+
+    backend_name = 'log'
+
+    # The log is compacted once it is larger than both this and the snapshot
+    COMPACT_MIN_BYTES = 1024 * 1024
+
+    def __init__(self, path: str, flush_delay: float = 0.05):
+        super().__init__(flush_delay)
+        self.path = path
+        self.log_path = f"{path}.log"
+        self.snapshot_path = f"{path}.snapshot"
+        self.legacy_path = f"{path}.json"
+        self._data = None
+        self._generation = 0
+        self._snapshot_bytes = 0
+        # End of the last intact record, and the log file it belongs to
+        self._log_bytes = 0
+        self._log_id = None
+        self._log = None
+        self._io_lock = asyncio.Lock()
+        # Set when the files can be read but not written (e.g. a read-only FS)
+        self.read_only = False
+
+    # Files (all called from a worker thread) -------------------------------
+
+    def _read_snapshot(self):
+        if not os.path.exists(self.snapshot_path):
+            return None
+        with open(self.snapshot_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            header_end = len(_SNAPSHOT_MAGIC) + _SNAPSHOT.size
+            if view[:len(_SNAPSHOT_MAGIC)] != _SNAPSHOT_MAGIC:
+                raise ValueError(f"{self.snapshot_path} is not a state snapshot")
+            generation, length, crc = _SNAPSHOT.unpack_from(view, len(_SNAPSHOT_MAGIC))
+            body = view[header_end:header_end + length]
+            if len(body) != length or zlib.crc32(body) != crc:
+                raise ValueError(f"{self.snapshot_path} is corrupt")
+            self._snapshot_bytes = len(view)
+            # Decoding allocates millions of containers and no garbage; cyclic
+            # GC passes triggered along the way would double the load time
+            gc_was_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                return generation, json.loads(body)
+            finally:
+                if gc_was_enabled:
+                    gc.enable()
+
+    def _replay_log(self, data: dict, offset: int, repair: bool = False) -> bool:
+        """Apply intact log records from offset to data; False if the log is not of this generation.
+
+        With repair, a torn tail is truncated; otherwise it may be a record
+        another process is still writing, and is read again next time.
+        """
+        with open(self.log_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < _LOG_HEADER_SIZE:
+                return False
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                if view[:len(_LOG_MAGIC)] != _LOG_MAGIC:
+                    return False
+                if _GENERATION.unpack_from(view, len(_LOG_MAGIC))[0] != self._generation:
+                    return False
+                end = max(offset, _LOG_HEADER_SIZE)
+                for body, end in _scan_records(view, end):
+                    _apply_record(data, json.loads(body))
+        if repair and end < size:
+            logger.warning("Dropping %d bytes of torn or corrupt records at the end of %s",
+                           size - end, self.log_path)
+            try:
+                with open(self.log_path, 'r+b') as f:
+                    f.truncate(end)
+                    os.fsync(f.fileno())
+            except OSError as exc:
+                self._set_read_only(exc)
+        self._log_bytes = end
+        self._log_id = (os.stat(self.log_path).st_ino, end)
+        return True
+
+    def _set_read_only(self, exc):
+        if not self.read_only:
+            self.read_only = True
+            logger.warning("State files at %s are not writable (%s); serving them read-only, "
+                           "writes will fail", self.path, exc)
+
+    def _migrate_legacy(self):
+        with open(self.legacy_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        data = data if isinstance(data, dict) else {}
+        try:
+            self._write_snapshot(1, data)
+            self._start_log()
+        except OSError as exc:
+            # E.g. a read-only deployment: the legacy file can still be served
+            self._set_read_only(exc)
+            self._data = data
+            return
+        self._data = data
+        os.replace(self.legacy_path, f"{self.legacy_path}.migrated")
+        logger.info("Migrated %s to %s", self.legacy_path, self.snapshot_path)
+
+    def _load_files(self):
+        # Built aside and swapped in at the end: on a reload after another
+        # process compacted, reads on the event loop keep seeing the old state
+        data = {}
+        self._generation = 0
+        self._snapshot_bytes = 0
+        snapshot = self._read_snapshot()
+        if snapshot is not None:
+            self._generation, data = snapshot
+        elif not os.path.exists(self.log_path) and os.path.exists(self.legacy_path):
+            self._migrate_legacy()
+            return
+        if not os.path.exists(self.log_path) or not self._replay_log(data, 0, repair=True):
+            try:
+                self._start_log()
+            except OSError as exc:
+                self._set_read_only(exc)
+        self._data = data
+
+    def _catch_up(self):
+        """Apply records appended (or a compaction done) by another process."""
+        if self._log_id is None:
+            return
+        current = _file_id(self.log_path)
+        if current is None or current == self._log_id:
+            return
+        if current[0] != self._log_id[0] or not self._replay_log(self._data, self._log_bytes):
+            # The log was replaced: start over from the new snapshot
+            self._close_log()
+            self._load_files()
+
+    def _write_snapshot(self, generation: int, data: dict):
+        body = json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        _atomic_write(self.snapshot_path, [
+            _SNAPSHOT_MAGIC, _SNAPSHOT.pack(generation, len(body), zlib.crc32(body)), body,
+        ])
+        self._generation = generation
+        self._snapshot_bytes = len(_SNAPSHOT_MAGIC) + _SNAPSHOT.size + len(body)
+
+    def _start_log(self):
+        self._close_log()
+        _atomic_write(self.log_path, [_LOG_MAGIC, _GENERATION.pack(self._generation)])
+        self._log_bytes = _LOG_HEADER_SIZE
+        self._log_id = _file_id(self.log_path)
+
+    def _close_log(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def _append(self, record: dict, bump_version: bool):
+        if self.read_only:
+            raise OSError(errno.EROFS, f"State files at {self.path} are read-only")
+        self._catch_up()
+        if bump_version:
+            record['v'] = self._data.get(VERSION_KEY, 0) + 1
+        chunk = _encode_record(record)
+        if self._log is None:
+            self._log = open(self.log_path, 'ab')
+        self._log.write(chunk)
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        self._log_bytes += len(chunk)
+        self._log_id = (self._log_id[0], self._log_bytes)
+        _apply_record(self._data, record)
+        if self._log_bytes > max(self.COMPACT_MIN_BYTES, self._snapshot_bytes):
+            self._write_snapshot(self._generation + 1, self._data)
+            self._start_log()
+
+    # Backend hooks -------------------------------------------------------
+
+    async def _run_io(self, function, *args):
+        async with self._io_lock:
+            return await asyncio.to_thread(function, *args)
+
+    async def _ensure_loaded(self):
+        if self._data is None:
+            try:
+                await self._run_io(self._load_files)
+            except Exception:
+                # Never fall back to empty state: the next compaction would overwrite the files
+                self._data = None
+                raise
+
+    async def _read(self, key):
+        await self._ensure_loaded()
+        return self._data.get(key)
+
+    async def _read_hash(self, key) -> dict:
+        await self._ensure_loaded()
+        value = self._data.get(key)
+        return dict(value) if isinstance(value, dict) else {}
+
+    async def _read_field(self, key, field):
+        await self._ensure_loaded()
+        value = self._data.get(key)
+        return value.get(field) if isinstance(value, dict) else None
+
+    async def _write(self, changes: dict, hash_changes: dict):
+        await self._ensure_loaded()
+        # The version bump (if any) is part of the same record
+        await self._run_io(
+            self._append, _batch_record(changes, hash_changes), self._bumps_version(changes, hash_changes))
+
+    async def _increment(self, key, increments: dict):
+        await self._ensure_loaded()
+        await self._run_io(self._append, {'i': {key: increments}}, False)
+
+    async def _read_version(self) -> int:
+        await self._ensure_loaded()
+        await self._run_io(self._catch_up)
+        return self._data.get(VERSION_KEY, 0)
+
+    async def _incr_version(self) -> int:
+        return self._data.get(VERSION_KEY, 0)
+
+    async def _close_backend(self):
+        async with self._io_lock:
+            self._close_log()
+
+
+class RedisRestStateStore(StateStore):
+    """Upstash Redis over its REST API, using the async client."""
+
+    backend_name = 'redis'
+
+    def __init__(self, url: str, token: str, flush_delay: float = 0.05):
+        super().__init__(flush_delay)
+        self._url = url
+        self._token = token
+        self._redis = None
+
+    @property
+    def _client(self):
+        # Created on first use: importing upstash_redis/aiohttp slows cold starts
+        if self._redis is None:
+            from aiohttp import ClientSession, TCPConnector
+            from upstash_redis.asyncio import Redis
+            from upstash_redis.asyncio.client import _SessionContextManager
+            redis = Redis(url=self._url, token=self._token)
+            # Without a session of its own the client opens (and TLS-handshakes)
+            # a new connection per command; share one keep-alive pool instead.
+            # This is what `async with Redis(...)` does, minus the 15s idle limit.
+            redis._context_manager = _SessionContextManager(
+                ClientSession(connector=TCPConnector(keepalive_timeout=REDIS_KEEPALIVE_SECONDS)),
+                close_session=False,
+            )
+            self._redis = redis
+        return self._redis
+
+    @staticmethod
+    def _encode(value) -> str:
+        return json.dumps(value, separators=(',', ':'))
+
+    @staticmethod
+    def _decode(raw):
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8')
+        if raw in (None, ""):
+            # Empty string was the legacy representation of "no value"
+            return None
+        try:
+            return json.loads(raw)
+        except (TypeError, ValueError):
+            # Legacy plain-string values (e.g. a bare file_id)
+            return raw
+
+    async def _read(self, key):
+        return self._decode(await self._client.get(key))
+
+    async def _read_hash(self, key) -> dict:
+        raw = await self._client.hgetall(key)
+        return {field: self._decode(value) for field, value in (raw or {}).items()}
+
+    async def _read_field(self, key, field):
+        return self._decode(await self._client.hget(key, field))
+
+    async def _write(self, changes: dict, hash_changes: dict):
+        to_set = {k: self._encode(v) for k, v in changes.items() if v is not _DELETED}
+        to_delete = [k for k, v in changes.items() if v is _DELETED]
+        if to_set:
+            await self._client.mset(to_set)
+        if to_delete:
+            await self._client.delete(*to_delete)
+        for key, fields in hash_changes.items():
+            values = {f: self._encode(v) for f, v in fields.items() if v is not _DELETED}
+            removed = [f for f, v in fields.items() if v is _DELETED]
+            if values:
+                await self._client.hset(key, values=values)
+            if removed:
+                await self._client.hdel(key, *removed)
+
+    async def _pipeline(self, commands: list) -> list:
+        """Run commands in one request to the REST /pipeline endpoint.
+
+        The async client has no pipeline support, so this posts directly
+        through its keep-alive session.
+        """
+        session = self._client._context_manager.session
+        async with session.post(
+            f"{self._url.rstrip('/')}/pipeline",
+            headers={'Authorization': f"Bearer {self._token}"},
+            json=commands,
+        ) as response:
+            replies = await response.json()
+        if not isinstance(replies, list):
+            raise RuntimeError(f"Pipeline failed: {replies}")
+        errors = [reply['error'] for reply in replies if 'error' in reply]
+        if errors:
+            raise RuntimeError(f"Pipeline failed: {errors[0]}")
+        return [reply.get('result') for reply in replies]
+
+    async def _increment(self, key, increments: dict):
+        await self._pipeline([['HINCRBY', key, field, amount] for field, amount in increments.items()])
+
+    async def _read_version(self) -> int:
+        value = await self._client.get(VERSION_KEY)
+        return int(value) if value not in (None, "") else 0
+
+    async def _incr_version(self) -> int:
+        return await self._client.incr(VERSION_KEY)
+
+    async def _set_nx(self, key, ttl: int) -> bool:
+        return bool(await self._client.set(key, '1', nx=True, ex=ttl))
+
+    async def _close_backend(self):
+        if self._redis is not None:
+            await self._redis.close()
+            self._redis = None
+
+
+def create_state_store(path: str = 'state') -> StateStore:
+    """Pick a backend from the environment: Redis if configured, else local files at path.
+
+    STATE_BACKEND (redis|log|memory) forces a backend ('json' is accepted as
+    an old name for log); STATE_FLUSH_DELAY_MS controls how long writes are
+    coalesced before flushing.
+    """
+    backend = (os.getenv('STATE_BACKEND') or '').lower()
+    flush_delay = int(os.getenv('STATE_FLUSH_DELAY_MS', '50')) / 1000
+    url = os.getenv('UPSTASH_REDIS_REST_URL')
+    token = os.getenv('UPSTASH_REDIS_REST_TOKEN')
+    if backend == 'memory':
+        return MemoryStateStore(flush_delay)
+    if backend in ('', 'redis') and url and token:
+        return RedisRestStateStore(url, token, flush_delay)
+    return LogStateStore(path, flush_delay)
@@ -0,0 +1,55 @@
+"""
+HTTPX request backend for the Bot API: persistent keep-alive pool and call timings
+"""
+
+import time
+import importlib.util
+
+import httpx
+from telegram.request import HTTPXRequest
+
+import metrics
+
+# How long an idle pooled connection is kept open (httpx defaults to 5s, which
+# drops the connection long before the next warm ping)
+KEEPALIVE_EXPIRY_SECONDS = 120.0
+
+
+def preferred_http_version() -> str:
+    """'2' when the h2 package is installed (python-telegram-bot[http2]), else '1.1'."""
+    return '2' if importlib.util.find_spec('h2') is not None else '1.1'
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest with long-lived keep-alive connections.
+
+    Every call is observed in the bot_api_request_seconds histogram.
+    """
+
+    __slots__ = ('_keepalive_expiry',)
+
+    def __init__(self, *args, keepalive_expiry: float = KEEPALIVE_EXPIRY_SECONDS, **kwargs):
+        # Read by _build_client(), which HTTPXRequest.__init__ calls
+        self._keepalive_expiry = keepalive_expiry
+        super().__init__(*args, **kwargs)
+
+    def _build_client(self) -> httpx.AsyncClient:
+        limits = self._client_kwargs['limits']
+        self._client_kwargs['limits'] = httpx.Limits(
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=self._keepalive_expiry,
+        )
+        return super()._build_client()
+
+    async def do_request(self, url, method, *args, **kwargs):
+        # url is <base_url><token>/<method>
+        api_method = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            status = str(code)
+            return code, payload
+        finally:
+            metrics.BOT_API_SECONDS.observe(time.perf_counter() - start, api_method, status)
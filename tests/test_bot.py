@@ -0,0 +1,31 @@
+import bot
+from library import VideoEntry, VideoLibrary
+
+
+def stored_of(*ids):
+    return {entry_id: VideoEntry(entry_id, f'file-{entry_id}', entry_id, added_at=i).to_dict()
+            for i, entry_id in enumerate(ids)}
+
+
+def test_reload_only_touches_changed_entries(monkeypatch):
+    library = VideoLibrary()
+    monkeypatch.setattr(bot, 'library', library)
+    monkeypatch.setattr(bot, '_applied_library', {})
+    bot._apply_stored_library(stored_of('a', 'b', 'c'))
+    assert [entry.id for entry in library.recent()] == ['c', 'b', 'a']
+    kept = library.get('a')
+
+    version = library.version
+    bot._apply_stored_library(stored_of('a', 'b', 'c'))
+    assert library.version == version
+
+    # Stored by this instance: in the library but not applied from a fetch yet
+    library.add(VideoEntry('d', 'file-d', 'd', added_at=3))
+    stored = stored_of('a', 'c', 'd')
+    stored['c']['title'] = 'renamed'
+    bot._apply_stored_library(stored)
+    assert library.get('a') is kept
+    assert 'b' not in library
+    assert library.get('c').title == 'renamed'
+    assert [entry.id for entry in library.search('renamed')] == ['c']
+    assert library.get('d').title == 'd'
@@ -0,0 +1,74 @@
+import asyncio
+from types import SimpleNamespace
+
+from dispatcher import KeyedUpdateProcessor
+
+
+def make_update(update_id, chat_id):
+    return SimpleNamespace(update_id=update_id, effective_chat=SimpleNamespace(id=chat_id), effective_user=None)
+
+
+async def handler(log, update_id, release=None):
+    log.append(f's{update_id}')
+    if release is not None:
+        await release.wait()
+    else:
+        await asyncio.sleep(0)
+    log.append(f'e{update_id}')
+
+
+def test_same_chat_runs_in_order():
+    async def main():
+        processor = KeyedUpdateProcessor(max_workers=4)
+        log = []
+        await asyncio.gather(*(
+            processor.do_process_update(make_update(i, 1), handler(log, i)) for i in range(5)
+        ))
+        return log, processor
+
+    log, processor = asyncio.run(main())
+    assert log == [f'{edge}{i}' for i in range(5) for edge in 'se']
+    assert processor._tails == {}
+    assert processor.queue_depth == 0
+
+
+def test_other_chats_do_not_wait():
+    async def main():
+        processor = KeyedUpdateProcessor(max_workers=4)
+        log = []
+        release = asyncio.Event()
+        first = asyncio.create_task(processor.do_process_update(make_update(1, 1), handler(log, 1, release)))
+        await asyncio.sleep(0)
+        await processor.do_process_update(make_update(2, 2), handler(log, 2))
+        release.set()
+        await first
+        return log
+
+    assert asyncio.run(main()) == ['s1', 's2', 'e2', 'e1']
+
+
+def test_cancelled_waiting_update_keeps_order():
+    async def main():
+        processor = KeyedUpdateProcessor(max_workers=4)
+        log = []
+        release = asyncio.Event()
+        running = asyncio.create_task(processor.do_process_update(make_update(10, 1), handler(log, 10, release)))
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(processor.do_process_update(make_update(11, 1), handler(log, 11)))
+        queued = asyncio.create_task(processor.do_process_update(make_update(12, 1), handler(log, 12)))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.sleep(0.01)
+        # A later update must still wait for the running one
+        late = asyncio.create_task(processor.do_process_update(make_update(13, 1), handler(log, 13)))
+        await asyncio.sleep(0.01)
+        assert log == ['s10']
+        release.set()
+        await asyncio.gather(running, queued, late)
+        assert waiting.cancelled()
+        return log, processor
+
+    log, processor = asyncio.run(main())
+    assert log == ['s10', 'e10', 's12', 'e12', 's13', 'e13']
+    assert processor._tails == {}
+    assert processor.queue_depth == 0
@@ -0,0 +1,161 @@
+import asyncio
+import types
+
+from ingest import IngestBatcher, dedupe
+from library import VideoEntry, VideoLibrary
+
+
+def entry(entry_id, title=''):
+    return VideoEntry(entry_id, f'file-{entry_id}', title)
+
+
+class Recorder:
+    """store callback over one library, recording each call."""
+
+    def __init__(self, *ids):
+        self.library = VideoLibrary()
+        for entry_id in ids:
+            self.library.add(entry(entry_id, entry_id))
+        self.calls = []
+
+    async def __call__(self, batch, reply):
+        added, duplicates = dedupe(self.library, batch.entries)
+        for item in added:
+            self.library.add(item)
+        self.calls.append(([e.id for e in added], [e.id for e in duplicates], reply))
+        return added, duplicates
+
+
+def test_dedupe_within_batch_and_against_library():
+    target = VideoLibrary()
+    target.add(entry('old', 'Old'))
+    added, duplicates = dedupe(target, [entry('a'), entry('old'), entry('a'), entry('b', 'Named')])
+    assert [e.id for e in added] == ['a', 'b']
+    assert [e.id for e in duplicates] == ['old', 'a']
+    # Untitled videos are numbered after what the library holds
+    assert [e.title for e in added] == ['Video 2', 'Named']
+
+
+def test_single_video_is_stored_right_away():
+    async def main():
+        store = Recorder()
+        batcher = IngestBatcher(store)
+        await batcher.add(1, 1, None, entry('a'), batched=False)
+        assert store.calls == [(['a'], [], True)]
+        assert len(batcher) == 0
+
+    asyncio.run(main())
+
+
+def test_album_is_stored_with_one_call_once_idle():
+    async def main():
+        store = Recorder('b')
+        batcher = IngestBatcher(store, window=0.01)
+        for entry_id in ('a', 'b', 'a', 'c'):
+            await batcher.add(1, 1, None, entry(entry_id), batched=True)
+        assert store.calls == []
+        await asyncio.sleep(0.05)
+        assert store.calls == [(['a', 'c'], ['b', 'a'], True)]
+        assert len(batcher) == 0
+
+    asyncio.run(main())
+
+
+def test_batch_is_stored_early_at_max_items():
+    async def main():
+        store = Recorder()
+        batcher = IngestBatcher(store, window=60, max_items=3)
+        for entry_id in 'abcd':
+            await batcher.add(1, 1, None, entry(entry_id), batched=True)
+        assert store.calls == [(['a', 'b', 'c'], [], True)]
+        # The fourth opened a new batch
+        assert batcher.stats()['pending_videos'] == 1
+        await batcher.finish_all()
+        assert store.calls[-1] == (['d'], [], True)
+
+    asyncio.run(main())
+
+
+def test_import_waits_for_finish():
+    async def main():
+        store = Recorder()
+        batcher = IngestBatcher(store, window=0.01)
+        batcher.start_import(1, 1, None)
+        assert batcher.in_import(1)
+        for entry_id in 'aba':
+            await batcher.add(1, 1, None, entry(entry_id), batched=False)
+        await asyncio.sleep(0.05)
+        # Unlike an album, an import is not stored after the short window
+        assert store.calls == []
+        batch = await batcher.finish(1)
+        assert [e.id for e in batch.entries] == ['a', 'b', 'a']
+        assert store.calls == [(['a', 'b'], ['a'], True)]
+        assert not batcher.in_import(1)
+        assert await batcher.finish(1) is None
+
+    asyncio.run(main())
+
+
+def test_import_times_out_when_idle():
+    async def main():
+        store = Recorder()
+        batcher = IngestBatcher(store, window=0.01, import_timeout=0.02)
+        batcher.start_import(1, 1, None)
+        await batcher.add(1, 1, None, entry('a'), batched=True)
+        assert not batcher.flush_due
+        await asyncio.sleep(0.05)
+        assert store.calls == [(['a'], [], True)]
+        assert not batcher.in_import(1)
+
+    asyncio.run(main())
+
+
+def test_immediate_mode_keeps_nothing_in_memory():
+    async def main():
+        store = Recorder('b')
+        batcher = IngestBatcher(store, window=60, immediate=True)
+        await batcher.add(1, 1, None, entry('a'), batched=True)
+        await batcher.add(1, 1, None, entry('b'), batched=True)
+        assert store.calls == [(['a'], [], True), ([], ['b'], True)]
+        assert batcher.stats()['pending_videos'] == 0
+
+        # During an import each video is stored at once but only /done replies
+        batcher.start_import(1, 1, None)
+        for entry_id in 'cac':
+            await batcher.add(1, 1, None, entry(entry_id), batched=True)
+        assert store.calls[2:] == [(['c'], [], False), ([], ['a'], False), ([], ['c'], False)]
+        batch = await batcher.finish(1)
+        assert (batch.stored, batch.skipped, batch.entries) == (1, 2, [])
+        assert len(store.calls) == 5
+
+    asyncio.run(main())
+
+
+def test_done_reports_import_in_immediate_mode(monkeypatch):
+    import bot
+
+    async def main():
+        store = Recorder()
+        batcher = IngestBatcher(store, immediate=True)
+        monkeypatch.setattr(bot, 'ingest_batcher', batcher)
+        replies = []
+
+        async def reply_text(text):
+            replies.append(text)
+
+        update = types.SimpleNamespace(
+            effective_user=types.SimpleNamespace(id=1),
+            effective_chat=types.SimpleNamespace(id=1),
+            message=types.SimpleNamespace(reply_text=reply_text),
+        )
+        # /import began on another instance: the videos are stored already
+        await bot.finish_import(update, None)
+        assert replies[-1].startswith("✅ Videos are stored as they arrive")
+
+        batcher.start_import(1, 1, None)
+        for entry_id in 'aab':
+            await batcher.add(1, 1, None, entry(entry_id), batched=True)
+        await bot.finish_import(update, None)
+        assert replies[-1] == "✅ Import done: stored 2 videos, skipped 1 already stored."
+
+    asyncio.run(main())
@@ -0,0 +1,71 @@
+from library import VideoEntry, VideoLibrary
+
+
+def make_library(count):
+    library = VideoLibrary()
+    for i in range(count):
+        library.add(VideoEntry(f'id{i}', f'file{i}', f'clip {i}', added_at=i))
+    return library
+
+
+def test_empty_query_ranks_by_popularity_then_recency():
+    library = make_library(10)
+    popularity = {'id2': 5, 'id7': 5, 'id4': 9, 'id3': 1, 'missing': 100}
+    ids = [entry.id for entry in library.search('', 6, popularity)]
+    # Ties on count go to the newer entry; unchosen entries follow newest first
+    assert ids == ['id4', 'id7', 'id2', 'id3', 'id9', 'id8']
+
+
+def test_empty_query_cut_off_inside_a_tie():
+    library = make_library(50)
+    popularity = {f'id{i}': 1 for i in range(50)}
+    popularity['id10'] = 2
+    ids = [entry.id for entry in library.search('', 3, popularity)]
+    assert ids == ['id10', 'id49', 'id48']
+
+
+def test_small_library_with_large_popularity_map():
+    library = make_library(3)
+    popularity = {f'other{i}': i for i in range(1000)}
+    popularity['id0'] = 1
+    assert [entry.id for entry in library.search('', 20, popularity)] == ['id0', 'id2', 'id1']
+
+
+def test_search_ranks_exact_title_matches_first():
+    library = VideoLibrary()
+    library.add(VideoEntry('a', 'fa', 'tango night', caption='tango'))
+    library.add(VideoEntry('b', 'fb', 'tangos', tags=['tango']))
+    library.add(VideoEntry('c', 'fc', 'tan lines'))
+    library.add(VideoEntry('d', 'fd', 'dog', caption='tangerine'))
+    assert [entry.id for entry in library.search('tan')] == ['c', 'b', 'a', 'd']
+    assert [entry.id for entry in library.search('tango')] == ['a', 'b']
+    assert [entry.id for entry in library.search('tango dog')] == []
+    assert [entry.id for entry in library.search('tan dog')] == ['d']
+
+
+def test_search_index_follows_replace_and_remove():
+    library = VideoLibrary()
+    library.add(VideoEntry('a', 'fa', 'alpha'))
+    library.add(VideoEntry('a', 'fa', 'beta'))
+    assert library.search('alp') == []
+    assert [entry.id for entry in library.search('be')] == ['a']
+    library.remove('a')
+    assert library.search('be') == []
+    assert library._postings == {} and library._tokens == []
+
+
+def test_search_pages_agree_with_full_ranking():
+    library = VideoLibrary()
+    for i in range(200):
+        library.add(VideoEntry(f'id{i}', f'file{i}', f'clip {"tango" if i % 3 else "tan"}', added_at=i % 7))
+    popularity = {f'id{i}': i % 4 for i in range(0, 200, 5)}
+    full = [entry.id for entry in library.search('ta', None, popularity)]
+    pages = []
+    offset = None
+    while True:
+        page, offset = library.search_page('ta', offset, 20, popularity)
+        pages.extend(entry.id for entry in page)
+        if not offset:
+            break
+    assert pages == full
+    assert len(full) == 200
@@ -0,0 +1,110 @@
+import asyncio
+import time
+
+import pytest
+from telegram.error import RetryAfter
+
+from outbound import PRIORITY_BACKGROUND, OutboundScheduler
+
+
+class Endpoint:
+    """Bot API method stub: raises RetryAfter(retry_after) floods times, then succeeds."""
+
+    def __init__(self, calls, name, floods=0, retry_after=0.2):
+        self.calls = calls
+        self.name = name
+        self.floods = floods
+        self.retry_after = retry_after
+
+    async def __call__(self):
+        self.calls.append((self.name, time.monotonic()))
+        if self.floods:
+            self.floods -= 1
+            raise RetryAfter(self.retry_after)
+        return self.name
+
+
+def request(scheduler, endpoint, method, chat_id=None, rate_limit_args=None):
+    data = {} if chat_id is None else {'chat_id': chat_id}
+    return scheduler.process_request(endpoint, (), {}, method, data, rate_limit_args)
+
+
+def test_chat_flood_wait_does_not_block_inline_answers():
+    async def main():
+        scheduler = OutboundScheduler()
+        calls = []
+        group = asyncio.create_task(
+            request(scheduler, Endpoint(calls, 'group', floods=1), 'sendMessage', -100))
+        await asyncio.sleep(0.01)
+        assert scheduler.stats()['paused_chats'] == 1
+
+        start = time.monotonic()
+        assert await request(scheduler, Endpoint(calls, 'inline'), 'answerInlineQuery') == 'inline'
+        assert time.monotonic() - start < 0.1
+        # Other chats are not held up either
+        assert await request(scheduler, Endpoint(calls, 'private'), 'sendMessage', 1) == 'private'
+        assert time.monotonic() - start < 0.1
+        assert scheduler.stats()['paused_for'] == 0
+
+        assert await group == 'group'
+        retried = [at for name, at in calls if name == 'group']
+        assert retried[1] - retried[0] >= 0.19
+
+    asyncio.run(main())
+
+
+def test_chatless_flood_wait_pauses_every_call():
+    async def main():
+        scheduler = OutboundScheduler()
+        calls = []
+        start = time.monotonic()
+        get_me = asyncio.create_task(request(scheduler, Endpoint(calls, 'getMe', floods=1), 'getMe'))
+        await asyncio.sleep(0.01)
+        assert scheduler.stats()['paused_for'] > 0
+        assert await request(scheduler, Endpoint(calls, 'private'), 'sendMessage', 1) == 'private'
+        assert time.monotonic() - start >= 0.19
+        assert await get_me == 'getMe'
+
+    asyncio.run(main())
+
+
+def test_inline_answer_is_not_sent_after_inline_timeout():
+    async def main():
+        scheduler = OutboundScheduler(inline_timeout=0.1)
+        calls = []
+        with pytest.raises(RetryAfter):
+            await request(scheduler, Endpoint(calls, 'inline', floods=1, retry_after=0.3), 'answerInlineQuery')
+        # Not retried: the pause outlasts the client's patience
+        assert len(calls) == 1
+
+        # Nor sent at all while the bot-wide pause would delay it past the timeout
+        start = time.monotonic()
+        with pytest.raises(RetryAfter):
+            await request(scheduler, Endpoint(calls, 'inline'), 'answerInlineQuery')
+        assert len(calls) == 1
+        assert time.monotonic() - start < 0.05
+
+    asyncio.run(main())
+
+
+def test_waiting_calls_are_released_in_priority_order():
+    async def main():
+        scheduler = OutboundScheduler()
+        calls = []
+        # A bot-wide flood wait holds every call until it ends
+        scheduler._pause('getMe', None, 0.05)
+        waiting = [
+            request(scheduler, Endpoint(calls, 'background'), 'sendMessage', 1,
+                    {'priority': PRIORITY_BACKGROUND}),
+            request(scheduler, Endpoint(calls, 'reply'), 'sendMessage', 2),
+            request(scheduler, Endpoint(calls, 'inline'), 'answerInlineQuery'),
+        ]
+        tasks = []
+        for call in waiting:
+            tasks.append(asyncio.create_task(call))
+            await asyncio.sleep(0)
+        assert scheduler.stats()['waiting'] == 3
+        await asyncio.gather(*tasks)
+        assert [name for name, _ in calls] == ['inline', 'reply', 'background']
+
+    asyncio.run(main())
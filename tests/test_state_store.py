@@ -0,0 +1,254 @@
+import os
+import errno
+import tempfile
+import json
+import asyncio
+import threading
+
+from state_store import LogStateStore, MemoryStateStore
+
+
+def test_log_store_survives_reopen_and_torn_tail(tmp_path):
+    path = str(tmp_path / 'state')
+
+    async def write():
+        store = LogStateStore(path)
+        store.set('a', 1)
+        store.hset('h', 'x', {'n': 1})
+        await store.flush()
+        store.hset('h', 'y', {'n': 2})
+        await store.flush()
+        await store.close()
+
+    asyncio.run(write())
+    # A crash in the middle of an append leaves a partial record behind
+    with open(f'{path}.log', 'ab') as f:
+        f.write(b'\x40\x00\x00\x00\x01\x02')
+
+    async def read():
+        store = LogStateStore(path)
+        value = await store.get('a'), await store.hgetall('h')
+        await store.close()
+        return value
+
+    assert asyncio.run(read()) == (1, {'x': {'n': 1}, 'y': {'n': 2}})
+    with open(f'{path}.log', 'rb') as f:
+        assert not f.read().endswith(b'\x01\x02')
+
+
+def test_log_store_compacts_and_ignores_stale_log(tmp_path):
+    path = str(tmp_path / 'state')
+
+    async def write():
+        store = LogStateStore(path)
+        store.COMPACT_MIN_BYTES = 256
+        for i in range(50):
+            store.hset('h', i, 'x' * 20)
+            await store.flush()
+        await store.close()
+        return store._generation
+
+    generation = asyncio.run(write())
+    assert generation > 1
+    assert os.path.getsize(f'{path}.log') < 1024
+
+    # A compaction interrupted after the new snapshot was written leaves the
+    # old-generation log behind; its records are in the snapshot already
+    async def interrupted_compaction():
+        store = LogStateStore(path)
+        await store.hgetall('h')
+        # Replaying the old log over this snapshot would undo the change
+        store._data['h']['0'] = 'snapshot'
+        store._write_snapshot(store._generation + 1, store._data)
+        store._close_log()
+
+    asyncio.run(interrupted_compaction())
+
+    async def read():
+        store = LogStateStore(path)
+        value = await store.hgetall('h')
+        await store.close()
+        return value
+
+    assert asyncio.run(read()) == {str(i): 'snapshot' if i == 0 else 'x' * 20 for i in range(50)}
+
+
+def test_log_store_migrates_legacy_json(tmp_path):
+    path = str(tmp_path / 'state')
+    with open(f'{path}.json', 'w') as f:
+        json.dump({'videos': {'v': {'file_id': 'f'}}}, f)
+
+    async def read():
+        store = LogStateStore(path)
+        value = await store.hgetall('videos')
+        await store.close()
+        return value
+
+    assert asyncio.run(read()) == {'v': {'file_id': 'f'}}
+    assert os.path.exists(f'{path}.json.migrated')
+    assert not os.path.exists(f'{path}.json')
+
+
+def test_reads_keep_old_state_while_reloading_after_compaction(tmp_path):
+    path = str(tmp_path / 'state')
+
+    async def main():
+        writer = LogStateStore(path)
+        writer.COMPACT_MIN_BYTES = 256
+        writer.set('key', 'old')
+        await writer.flush()
+
+        reader = LogStateStore(path)
+        await reader.refresh_version()
+        assert await reader._read('key') == 'old'
+
+        for i in range(30):
+            writer.set('key', f'new {i}')
+            await writer.flush()
+        assert writer._generation > 1
+
+        # Hold the reader's snapshot decode until a read was made meanwhile
+        decoding = threading.Event()
+        release = threading.Event()
+        read_snapshot = reader._read_snapshot
+
+        def slow_read_snapshot():
+            decoding.set()
+            release.wait(5)
+            return read_snapshot()
+
+        reader._read_snapshot = slow_read_snapshot
+        reload = asyncio.ensure_future(reader.refresh_version())
+        while not decoding.is_set():
+            await asyncio.sleep(0.001)
+        assert await reader._read('key') == 'old'
+        release.set()
+        assert await reload
+        assert await reader._read('key') == 'new 29'
+        await writer.close()
+        await reader.close()
+
+    asyncio.run(main())
+
+
+class FlakyStore(MemoryStateStore):
+    """Memory store whose writes can be held open or made to fail."""
+
+    def __init__(self, flush_delay=0.0):
+        super().__init__(flush_delay)
+        self.writes = 0
+        self.failures = 0
+        self.hold = None
+
+    async def _write(self, changes, hash_changes):
+        self.writes += 1
+        if self.hold is not None:
+            await self.hold.wait()
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('backend unavailable')
+        await super()._write(changes, hash_changes)
+
+
+def test_writes_are_coalesced_into_one_flush():
+    async def main():
+        store = FlakyStore(flush_delay=0.01)
+        store.set('a', 1)
+        store.set('a', 2)
+        store.hset('h', 'x', 1)
+        store.hset('h', 'y', 2)
+        store.hdel('h', 'x')
+        await asyncio.sleep(0.05)
+        return store
+
+    store = asyncio.run(main())
+    assert store.writes == 1
+    assert store._data['a'] == 2 and store._data['h'] == {'y': 2}
+    assert not store.dirty
+
+
+def test_failed_flush_keeps_fields_written_after_a_delete():
+    async def main():
+        store = FlakyStore()
+        store.FLUSH_RETRY_MIN = 0.01
+        store._data['videos'] = {'old': 1}
+        # /clear then an upload, both in the batch that fails
+        store.delete('videos')
+        store.hset('videos', 'new', 2)
+        store.failures = 1
+        await store.flush()
+        assert store.dirty
+        assert await store.hgetall('videos') == {'new': 2}
+        # Retried on its own, without another write to trigger it
+        await asyncio.sleep(0.1)
+        return store
+
+    store = asyncio.run(main())
+    assert store._data['videos'] == {'new': 2}
+    assert not store.dirty
+
+
+def test_failed_batch_stays_under_newer_writes():
+    async def main():
+        store = FlakyStore()
+        store.FLUSH_RETRY_MIN = 0.01
+        store.set('a', 1)
+        store.hset('h', 'x', 1)
+        store.failures = 1
+        store.hold = asyncio.Event()
+        flush = asyncio.ensure_future(store.flush())
+        await asyncio.sleep(0)
+        # Written while the failing batch is in flight
+        store.set('a', 2)
+        store.delete('h')
+        store.hold.set()
+        await flush
+        store.hold = None
+        await asyncio.sleep(0.1)
+        return store
+
+    store = asyncio.run(main())
+    assert store._data['a'] == 2
+    assert 'h' not in store._data
+
+
+def test_close_during_a_write_does_not_lose_it():
+    async def main():
+        store = FlakyStore(flush_delay=0.0)
+        store.hold = asyncio.Event()
+        store.set('a', 1)
+        await asyncio.sleep(0.01)
+        assert store.writes == 1
+        closing = asyncio.ensure_future(store.close())
+        await asyncio.sleep(0.01)
+        store.hold.set()
+        await closing
+        return store
+
+    store = asyncio.run(main())
+    assert store._data.get('a') == 1
+    assert not store.dirty
+
+
+def test_log_store_serves_legacy_json_on_a_read_only_fs(tmp_path, monkeypatch):
+    path = str(tmp_path / 'state')
+    with open(f'{path}.json', 'w') as f:
+        json.dump({'videos': {'v': {'file_id': 'f'}}}, f)
+
+    def read_only(*args, **kwargs):
+        raise OSError(errno.EROFS, 'Read-only file system')
+
+    monkeypatch.setattr(tempfile, 'mkstemp', read_only)
+
+    async def main():
+        store = LogStateStore(path)
+        store.FLUSH_RETRY_MIN = 60
+        videos = await store.hgetall('videos')
+        store.set('a', 1)
+        await store.flush()
+        return store, videos, store.dirty
+
+    store, videos, dirty = asyncio.run(main())
+    assert videos == {'v': {'file_id': 'f'}}
+    assert store.read_only and dirty
+    assert os.path.exists(f'{path}.json')
@@ -0,0 +1,95 @@
+import asyncio
+
+from library import VideoEntry, VideoLibrary
+from state_store import MemoryStateStore
+from user_libraries import UserLibraries
+
+
+def make_instances():
+    """Two instances' stores and caches over one shared backend."""
+    first, second = MemoryStateStore(), MemoryStateStore()
+    second._data = first._data
+    return (
+        (first, UserLibraries(first, 'user_videos', 1 << 20, revalidate=0)),
+        (second, UserLibraries(second, 'user_videos', 1 << 20, revalidate=0)),
+    )
+
+
+def library_of(*ids):
+    library = VideoLibrary()
+    for entry_id in ids:
+        library.add(VideoEntry(entry_id, f'file-{entry_id}', entry_id))
+    return library
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_user_writes_do_not_bump_state_version():
+    async def main():
+        (store, users), (other, _) = make_instances()
+        await other.refresh_version()
+        users.save(1, library_of('a'))
+        await store.flush()
+        assert not await other.refresh_version()
+        store.set('videos', {})
+        await store.flush()
+        assert await other.refresh_version()
+
+    asyncio.run(main())
+
+
+def test_other_instance_reloads_only_the_changed_user():
+    async def main():
+        (store_a, users_a), (store_b, users_b) = make_instances()
+        users_a.save(1, library_of('a'))
+        users_a.save(2, library_of('b'))
+        await store_a.flush()
+        assert len(await users_b.get(1)) == 1
+        assert len(await users_b.get(2)) == 1
+
+        users_a.save(1, library_of('a', 'c'))
+        await store_a.flush()
+        # The outdated library is served while the check runs in the background
+        assert len(await users_b.get(1)) == 1
+        await users_b.get(2)
+        await settle()
+        assert len(await users_b.get(1)) == 2
+        assert users_b.reloads == 1
+
+        users_a.save(1, None)
+        await store_a.flush()
+        await users_b.get(1)
+        await settle()
+        assert await users_b.get(1) is None
+        await settle()
+        assert users_b.reloads == 2
+
+    asyncio.run(main())
+
+
+def test_changes_start_from_the_stored_library():
+    async def main():
+        (store_a, users_a), (store_b, users_b) = make_instances()
+        users_a.save(1, library_of('x'))
+        await store_a.flush()
+        # Both instances have the library cached
+        await users_a.get(1)
+        await users_b.get(1)
+
+        library = await users_a.get_current(1)
+        library.add(VideoEntry('y', 'file-y', 'y'))
+        users_a.save(1, library)
+        await store_a.flush()
+
+        library = await users_b.get_current(1)
+        library.add(VideoEntry('z', 'file-z', 'z'))
+        users_b.save(1, library)
+        await store_b.flush()
+        return store_a
+
+    store = asyncio.run(main())
+    stored = store._data['user_videos']['1']
+    assert sorted(key for key in stored if not key.startswith('#')) == ['x', 'y', 'z']
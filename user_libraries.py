@@ -0,0 +1,212 @@
+"""
+Per-user video libraries, loaded on demand into a byte-bounded LRU
+"""
+
+import os
+import time
+import asyncio
+from collections import OrderedDict
+
+from library import VideoEntry, VideoLibrary
+
+# Rough memory costs used for the cache budget (object and index overhead
+# dominates the raw strings for small libraries)
+LIBRARY_OVERHEAD_BYTES = 1024
+ENTRY_OVERHEAD_BYTES = 768
+ABSENT_BYTES = 128
+
+# Reserved field in a user's stored videos holding the version they were
+# saved with (entry ids are Telegram file ids, which never contain '#')
+VERSION_FIELD = '#v'
+
+
+def estimate_bytes(library) -> int:
+    """Approximate memory held by a cached library (None: user has no videos)."""
+    if library is None:
+        return ABSENT_BYTES
+    total = LIBRARY_OVERHEAD_BYTES
+    for entry in library.recent():
+        text = len(entry.file_id) + len(entry.title) + len(entry.caption) + sum(map(len, entry.tags))
+        # Strings are held by the entry and again as index tokens
+        total += ENTRY_OVERHEAD_BYTES + 2 * text
+    return total
+
+
+class _Cached:
+    """A cached library with the version it was read at."""
+
+    __slots__ = ('library', 'size', 'version', 'checked')
+
+    def __init__(self, library, size, version, checked):
+        self.library = library
+        self.size = size
+        self.version = version
+        self.checked = checked
+
+
+class UserLibraries:
+    """Each user's own VideoLibrary, persisted in a single store hash.
+
+    The hash at key has one field per user id holding {entry id: entry dict},
+    so storage grows by one field per user rather than one key. Libraries are
+    kept in an LRU bounded by an estimate of their memory; users without
+    videos are cached too, as small negative entries, so their inline queries
+    do not hit the store every time.
+
+    A miss reads only that user's field. Concurrent misses for one user share
+    a single read, and lookups for other users never wait on it.
+
+    Changes are not tracked by the store's global version, which would make
+    every instance reload everything on any user's upload. Instead each
+    save writes a random version token both into the user's field and into
+    a small <key>_version hash. A cached library older than revalidate
+    seconds is still served, while a background read of the user's token
+    checks it; only that user's entry is reloaded if the token moved.
+    """
+
+    def __init__(self, store, key: str, max_bytes: int, revalidate: float = 10.0):
+        self.store = store
+        self.key = key
+        self.version_key = f"{key}_version"
+        self.max_bytes = max_bytes
+        self.revalidate = revalidate
+        store.exclude_from_version(self.key, self.version_key)
+        # user id -> _Cached
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._checking = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reloads = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def get(self, user_id):
+        """The user's library, or None if they have no videos. Loads on a miss."""
+        item = self._entries.get(user_id)
+        if item is not None:
+            self.hits += 1
+            self._entries.move_to_end(user_id)
+            if time.monotonic() - item.checked >= self.revalidate:
+                self._schedule_check(user_id)
+            return item.library
+        self.misses += 1
+        task = self._loading.get(user_id)
+        if task is None:
+            task = self._loading[user_id] = asyncio.ensure_future(self._load(user_id))
+        return await asyncio.shield(task)
+
+    async def _load(self, user_id, replacing=None):
+        """Read the user's library; replacing is the outdated entry it may overwrite."""
+        try:
+            stored = await self.store.hget(self.key, user_id)
+            library = None
+            version = None
+            if isinstance(stored, dict):
+                stored = dict(stored)
+                version = stored.pop(VERSION_FIELD, None)
+            if isinstance(stored, dict) and stored:
+                library = VideoLibrary()
+                entries = [VideoEntry.from_dict(entry_id, data) for entry_id, data in stored.items()]
+                for entry in sorted(entries, key=lambda e: e.added_at):
+                    library.add(entry)
+            # A save() that landed while this read was in flight is newer
+            current = self._entries.get(user_id)
+            if current is None or current is replacing:
+                self._put(user_id, library, version)
+            return self._entries[user_id].library
+        finally:
+            self._loading.pop(user_id, None)
+
+    def _schedule_check(self, user_id):
+        if user_id in self._checking or user_id in self._loading:
+            return
+        self._checking[user_id] = asyncio.ensure_future(self._check(user_id))
+
+    async def _check(self, user_id):
+        """Reload the user's library if another instance saved it since it was read."""
+        try:
+            await self._revalidate(user_id)
+        except Exception:
+            # Keep serving the cached library; the next lookup checks again
+            pass
+        finally:
+            self._checking.pop(user_id, None)
+
+    async def _revalidate(self, user_id):
+        item = self._entries.get(user_id)
+        if item is None:
+            return await self.get(user_id)
+        task = self._loading.get(user_id)
+        if task is None:
+            version = await self.store.hget(self.version_key, user_id)
+            item = self._entries.get(user_id)
+            if item is None:
+                return await self.get(user_id)
+            if version == item.version:
+                item.checked = time.monotonic()
+                return item.library
+            # Serve the outdated entry until the reload replaces it
+            self.reloads += 1
+            task = self._loading.get(user_id)
+            if task is None:
+                task = self._loading[user_id] = asyncio.ensure_future(self._load(user_id, item))
+        return await asyncio.shield(task)
+
+    async def get_current(self, user_id):
+        """Like get(), but first makes sure a cached library is still the stored one.
+
+        For changes: save() writes the whole library back, so a library
+        another instance saved meanwhile would be overwritten. Costs one
+        version read when cached.
+        """
+        return await self._revalidate(user_id)
+
+    def save(self, user_id, library):
+        """Cache the user's (modified) library and queue it for persistence."""
+        if library is None or not len(library):
+            library = None
+            version = None
+            self.store.hdel(self.key, user_id)
+            self.store.hdel(self.version_key, user_id)
+        else:
+            version = os.urandom(6).hex()
+            stored = {entry.id: entry.to_dict() for entry in library.recent()}
+            stored[VERSION_FIELD] = version
+            self.store.hset(self.key, user_id, stored)
+            self.store.hset(self.version_key, user_id, version)
+        self._put(user_id, library, version)
+
+    def _put(self, user_id, library, version):
+        self._drop(user_id)
+        size = estimate_bytes(library)
+        self._entries[user_id] = _Cached(library, size, version, time.monotonic())
+        self.bytes += size
+        while self.bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= evicted.size
+            self.evictions += 1
+
+    def _drop(self, user_id):
+        previous = self._entries.pop(user_id, None)
+        if previous is not None:
+            self.bytes -= previous.size
+
+    def invalidate(self):
+        """Forget every cached library (e.g. after another instance changed state)."""
+        self._entries.clear()
+        self.bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            'users': len(self._entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'reloads': self.reloads,
+        }
@@ -0,0 +1,97 @@
+"""
+Single-flight warm-up and connection keep-alive for the webhook app
+"""
+
+import time
+import asyncio
+import logging
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class WarmupManager:
+    """Coalesces initialization and keeps outbound connection pools hot.
+
+    once(name, factory) runs factory a single time per instance: concurrent
+    callers await the same in-flight task, and a failed run is retried by the
+    next caller. warm() runs every pinger (name -> async callable) in parallel,
+    joining a warm-up that is already in flight. start_keepalive() repeats
+    warm() every interval seconds so pooled keep-alive connections are reused
+    instead of re-established (TCP + TLS) by the next real update.
+    """
+
+    def __init__(self, pingers: dict, interval: float = 20.0):
+        self.pingers = pingers
+        self.interval = interval
+        self._tasks = {}
+        self._done = set()
+        self._keepalive_task = None
+        # name -> duration of the last ping in ms (None if it failed)
+        self.last_ping = {}
+
+    def is_done(self, name: str) -> bool:
+        return name in self._done
+
+    async def _single_flight(self, name, factory, remember):
+        task = self._tasks.get(name)
+        if task is None:
+            task = asyncio.ensure_future(self._run(name, factory, remember))
+            self._tasks[name] = task
+        # Shielded so one cancelled caller does not cancel the others' work
+        return await asyncio.shield(task)
+
+    async def _run(self, name, factory, remember):
+        try:
+            with metrics.WARM_SECONDS.time(name):
+                result = await factory()
+            if remember:
+                self._done.add(name)
+            return result
+        finally:
+            self._tasks.pop(name, None)
+
+    async def once(self, name: str, factory):
+        """Run factory() once per instance; concurrent callers share one run."""
+        if name not in self._done:
+            await self._single_flight(name, factory, remember=True)
+
+    async def _ping(self, name, pinger):
+        start = time.perf_counter()
+        try:
+            await pinger()
+        except Exception as exc:
+            logger.warning("Warm ping %r failed: %s", name, exc)
+            self.last_ping[name] = None
+            return
+        self.last_ping[name] = round((time.perf_counter() - start) * 1000, 1)
+
+    async def _ping_all(self):
+        await asyncio.gather(*(self._ping(name, pinger) for name, pinger in self.pingers.items()))
+        return dict(self.last_ping)
+
+    async def warm(self) -> dict:
+        """Ping every pool in parallel; returns {name: ms or None}."""
+        return await self._single_flight('ping', self._ping_all, remember=False)
+
+    def start_keepalive(self):
+        """Start the background keep-alive loop (no-op if running or disabled)."""
+        if self.interval <= 0:
+            return
+        if self._keepalive_task is not None and not self._keepalive_task.done():
+            return
+        self._keepalive_task = asyncio.get_running_loop().create_task(self._keepalive())
+
+    async def _keepalive(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.warm()
+
+    def stats(self) -> dict:
+        return {
+            'done': sorted(self._done),
+            'in_flight': sorted(self._tasks),
+            'keepalive_seconds': self.interval,
+            'last_ping_ms': dict(self.last_ping),
+        }